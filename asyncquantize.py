@@ -0,0 +1,162 @@
+"""
+  Asynchronous quantization
+
+  Lets an asyncio application (e.g. an aiohttp service) quantize images
+  without blocking its event loop. Decoding, clustering, encoding and any
+  file reads and writes run on a bounded pool of worker threads, each with
+  its own warm engine. The C library releases the GIL during its passes,
+  so the workers really run in parallel (the Python fallback takes turns).
+
+  At most maxConcurrent images are in flight; further calls wait for a
+  slot. Cancelling the awaiting task stops the run after its current pass
+  and frees the slot once the worker is done with it.
+
+  Usage:
+  async with AsyncQuantizer(workers=4) as quantizer:
+    result = await quantizer.quantize(body, K=16, format="webp")
+    # result.output is the encoded image, result.stats as in server.py
+
+    async for event in quantizer.stream("photo.jpg", "out.png", K=8):
+      if isinstance(event, Progress):
+        print(event.numPass, event.inertia)
+
+  The parameters are those of server.Job: K, T, metric, format, bisect,
+  nInit, resize, space and sample.
+"""
+
+import os
+import asyncio
+import threading
+import collections
+import concurrent.futures
+
+import quantize
+from server import Job
+
+# yielded by stream after every assignment pass, then the Result
+Progress = collections.namedtuple("Progress", ["numPass", "inertia"])
+Result = collections.namedtuple("Result", ["output", "stats"])
+
+"""
+  AsyncQuantizer:
+  Owns the worker threads and their engines. workers defaults to one per
+  CPU and maxConcurrent to the number of workers.
+"""
+class AsyncQuantizer:
+  def __init__(self, workers=None, maxConcurrent=None):
+    self.workers = max(1, workers or os.cpu_count() or 1)
+    self.executor = concurrent.futures.ThreadPoolExecutor(self.workers,
+      thread_name_prefix="quantize")
+    self.slots = asyncio.Semaphore(maxConcurrent or self.workers)
+    # one engine per worker thread, all closed by close()
+    self.local = threading.local()
+    self.engines = []
+    self.lock = threading.Lock()
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *exc):
+    await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+  # the calling worker thread's engine (None for the Python version)
+  def getEngine(self):
+    if not quantize.useCLib:
+      return None
+
+    engine = getattr(self.local, "engine", None)
+    if engine is None:
+      engine = self.local.engine = quantize.ckmeans.Engine(
+        quantize.libkmeans)
+      with self.lock:
+        self.engines.append(engine)
+
+    return engine
+
+  # runs on a worker: image is the file's bytes or its path. Returns None
+  # if stop stopped the run.
+  def run(self, image, outputPath, params, stop):
+    if isinstance(image, (str, os.PathLike)):
+      with open(image, "rb") as f:
+        image = f.read()
+
+    try:
+      job = Job(bytes(image), **params)
+    except IOError:
+      raise ValueError("the image is not one PIL can read")
+
+    if not job.run(self.getEngine(), stop):
+      return None
+
+    if outputPath is not None:
+      with open(outputPath, "wb") as f:
+        f.write(job.output)
+
+    return Result(job.output, job.stats)
+
+  # quantizes an image (bytes or a path), optionally saving the output to
+  # outputPath, and returns the Result
+  async def quantize(self, image, outputPath=None, **params):
+    result = None
+
+    async for event in self.stream(image, outputPath, **params):
+      result = event
+
+    return result
+
+  # the same as an async iterator: a Progress for every pass, then the
+  # Result. Errors (e.g. ValueError for an unreadable image) are raised
+  # from the iteration.
+  async def stream(self, image, outputPath=None, **params):
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    cancelled = threading.Event()
+
+    def stop(numPass, inertia):
+      if not cancelled.is_set():
+        loop.call_soon_threadsafe(events.put_nowait,
+          Progress(numPass, inertia))
+      return cancelled.is_set()
+
+    # the Result (None if stopped) or the exception ends the events
+    def work():
+      if cancelled.is_set():
+        return
+
+      try:
+        result = self.run(image, outputPath, params, stop)
+      except Exception as e:
+        result = e
+
+      if not cancelled.is_set():
+        loop.call_soon_threadsafe(events.put_nowait, result)
+
+    async with self.slots:
+      future = loop.run_in_executor(self.executor, work)
+
+      try:
+        while True:
+          event = await events.get()
+
+          if isinstance(event, Exception):
+            raise event
+          if event is None:
+            return
+
+          yield event
+
+          if isinstance(event, Result):
+            return
+      finally:
+        # cancelled or abandoned: stop after the current pass, and keep
+        # the slot until the worker has actually let go of it
+        cancelled.set()
+        await asyncio.wait([future])
+
+  def close(self):
+    self.executor.shutdown(wait=True)
+
+    with self.lock:
+      for engine in self.engines:
+        engine.close()
+      del self.engines[:]
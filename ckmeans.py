@@ -16,24 +16,26 @@ except ImportError:
   hasCTypes = False
 
 import os
+import random
 import platform
 
 # distance metrics
 Euclidean, Manhattan = list(range(0, 2))
 
-# point type is a pointer representing RGB components
-Point = ctypes.POINTER(ctypes.c_int)
-# point array type (any number of points)
-PointArray = ctypes.POINTER(Point)
+# point type is a pointer to the D components of a point (or several
+# points stored one after another)
+Point = ctypes.POINTER(ctypes.c_float)
+# label array type
+LabelArray = ctypes.POINTER(ctypes.c_int)
+# 64-bit index array type (images can have more than 2^31 pixels)
+IndexArray = ctypes.POINTER(ctypes.c_int64)
 
 # ctypes struct definition of a cluster
 class CCluster(ctypes.Structure):
   _fields_ = [
-    ("points", PointArray),
-    ("indices", Point),
     ("centroid", Point),
     ("prevCentroid", Point),
-    ("size", ctypes.c_int)
+    ("size", ctypes.c_int64)
   ]
 
 # ctypes k-means struct
@@ -42,11 +44,24 @@ class CKMeans(ctypes.Structure):
     ("K", ctypes.c_int),
     ("T", ctypes.c_float),
     ("metric", ctypes.c_int),
-    ("data_size", ctypes.c_int),
+    ("data_size", ctypes.c_int64),
+    ("D", ctypes.c_int),
     ("dist", ctypes.c_void_p),
-    ("lower", ctypes.c_int * 3),
-    ("upper", ctypes.c_int * 3),
-    ("clusters", ctypes.POINTER(CCluster))
+    ("lower", Point),
+    ("upper", Point),
+    ("clusters", ctypes.POINTER(CCluster)),
+    ("weights", IndexArray),
+    ("data", Point),
+    ("labels", LabelArray),
+    ("order", IndexArray),
+    ("sums", ctypes.POINTER(ctypes.c_double)),
+    ("centroids", Point),
+    ("bounds", Point),
+    ("data_capacity", ctypes.c_int64),
+    ("K_capacity", ctypes.c_int),
+    ("D_capacity", ctypes.c_int),
+    ("seed", ctypes.c_uint32),
+    ("inertia", ctypes.c_double)
   ]
 
 def hasCTypes():
@@ -93,59 +108,165 @@ def load():
       ctypes.c_int,
       ctypes.c_float,
       ctypes.c_int,
+      ctypes.c_int64,
       ctypes.c_int
     ]
     libkmeans.init_clusters.argtypes = [
       ctypes.POINTER(CKMeans),
-      ctypes.c_int * 3,
-      ctypes.c_int * 3
+      Point,
+      Point
     ]
     libkmeans.assign_clusters.argtypes = [
       ctypes.POINTER(CKMeans),
-      ctypes.POINTER(ctypes.c_int * 3)
+      Point
+    ]
+    libkmeans.set_weights.argtypes = [
+      ctypes.POINTER(CKMeans),
+      IndexArray
+    ]
+    libkmeans.bisect_clusters.argtypes = [
+      ctypes.POINTER(CKMeans),
+      Point,
+      ctypes.c_int
+    ]
+    libkmeans.seed_clusters.argtypes = [
+      ctypes.POINTER(CKMeans),
+      Point,
+      ctypes.c_int
+    ]
+    libkmeans.predict_bytes.argtypes = [
+      ctypes.POINTER(CKMeans),
+      ctypes.c_char_p,
+      ctypes.c_int64,
+      ctypes.c_void_p,
+      ctypes.c_int
+    ]
+    libkmeans.bytes_to_floats.argtypes = [
+      ctypes.c_char_p,
+      ctypes.c_int64,
+      Point
+    ]
+    libkmeans.sample_bytes.argtypes = [
+      ctypes.POINTER(CKMeans),
+      ctypes.c_char_p,
+      ctypes.c_int64,
+      ctypes.c_int,
+      ctypes.c_int64,
+      ctypes.c_char_p
+    ]
+    libkmeans.set_seed.argtypes = [
+      ctypes.POINTER(CKMeans),
+      ctypes.c_uint32
+    ]
+    libkmeans.get_cluster_errors.argtypes = [
+      ctypes.POINTER(CKMeans),
+      ctypes.POINTER(ctypes.c_double)
     ]
     libkmeans.update_clusters.argtypes = [ctypes.POINTER(CKMeans)]
     libkmeans.get_convergence.argtypes = [ctypes.POINTER(CKMeans)]
+    libkmeans.get_inertia.argtypes = [ctypes.POINTER(CKMeans)]
     libkmeans.get_threshold.argtypes = [ctypes.POINTER(CKMeans)]
     libkmeans.get_clusters.argtypes = [ctypes.POINTER(CKMeans)]
+    libkmeans.get_labels.argtypes = [ctypes.POINTER(CKMeans)]
     libkmeans.clear_clusters.argtypes = [ctypes.POINTER(CKMeans)]
     libkmeans.free_clusters.argtypes = [ctypes.POINTER(CKMeans)]
 
     # set the return types
-    libkmeans.euclidean.restype = ctypes.c_int
-    libkmeans.manhattan.restype = ctypes.c_int
+    libkmeans.euclidean.restype = ctypes.c_float
+    libkmeans.manhattan.restype = ctypes.c_float
+    libkmeans.init_clusters.restype = ctypes.c_int
+    libkmeans.bisect_clusters.restype = ctypes.c_int
+    libkmeans.predict_bytes.restype = ctypes.c_int
     libkmeans.get_clusters.restype = ctypes.POINTER(CCluster)
+    libkmeans.get_labels.restype = LabelArray
     libkmeans.get_threshold.restype = ctypes.c_float
-    libkmeans.get_convergence.restype = ctypes.c_float
+    libkmeans.get_convergence.restype = ctypes.c_double
+    libkmeans.get_inertia.restype = ctypes.c_double
   except:
     libkmeans = None
     print("Failed to load C library.")
 
   return libkmeans
 
-def init(libkmeans, kmeans, K, T, metric, data_size):
+def init(libkmeans, kmeans, K, T, metric, data_size, D=3):
   libkmeans.init(
     ctypes.byref(kmeans),
     ctypes.c_int(K),
     ctypes.c_float(T),
     ctypes.c_int(metric),
-    ctypes.c_int(data_size)
+    ctypes.c_int64(data_size),
+    ctypes.c_int(D)
   )
 
+# lower (inclusive) and upper (exclusive) bounds have D values each
 def init_clusters(libkmeans, kmeans, lower, upper):
-  libkmeans.init_clusters(
+  if not libkmeans.init_clusters(
     ctypes.byref(kmeans),
-    (ctypes.c_int * 3)(*lower),
-    (ctypes.c_int * 3)(*upper)
-  )
+    (ctypes.c_float * kmeans.D)(*lower),
+    (ctypes.c_float * kmeans.D)(*upper)
+  ):
+    raise MemoryError("Not enough memory for %d points and %d clusters" %
+      (kmeans.data_size, kmeans.K))
+
+def set_seed(libkmeans, kmeans, seed):
+  libkmeans.set_seed(ctypes.byref(kmeans), ctypes.c_uint32(seed))
 
 def clear_clusters(libkmeans, kmeans):
   libkmeans.clear_clusters(ctypes.byref(kmeans))
 
-def assign_clusters(libkmeans, kmeans, data):
-  cdata = ((ctypes.c_int * 3) * len(data))()
+# converts a sequence of D-tuples (e.g. RGB colors, or RGB+XY feature
+# vectors) to the C data layout: an array of n arrays of D floats.
+# Converting once and passing the result to the functions below saves
+# redoing it every pass.
+def to_c_data(data):
+  if isinstance(data, ctypes.Array):
+    return data
+
+  cdata = ((ctypes.c_float * dimensions(data)) * len(data))()
   cdata[:] = data
-  libkmeans.assign_clusters(ctypes.byref(kmeans), cdata)
+  return cdata
+
+# number of components of the points in data (3 if there are none)
+def dimensions(data):
+  if isinstance(data, ctypes.Array):
+    return data._type_._length_
+  return len(data[0]) if len(data) else 3
+
+# the data as the float pointer the library takes
+def as_points(cdata):
+  return ctypes.cast(cdata, Point)
+
+def seed_clusters(libkmeans, kmeans, seeds):
+  libkmeans.seed_clusters(ctypes.byref(kmeans),
+    as_points(to_c_data(seeds)), ctypes.c_int(len(seeds)))
+
+def assign_clusters(libkmeans, kmeans, data):
+  libkmeans.assign_clusters(ctypes.byref(kmeans),
+    as_points(to_c_data(data)))
+
+# the returned array has to be kept alive until free_clusters is called
+def set_weights(libkmeans, kmeans, weights):
+  cweights = (ctypes.c_int64 * len(weights))(*weights)
+  libkmeans.set_weights(ctypes.byref(kmeans), cweights)
+  return cweights
+
+def bisect_clusters(libkmeans, kmeans, data, passes=10):
+  if not libkmeans.bisect_clusters(ctypes.byref(kmeans),
+    as_points(to_c_data(data)), ctypes.c_int(passes)):
+    raise MemoryError("Not enough memory to bisect into %d clusters" %
+      kmeans.K)
+
+# labels the points in pixels (bytes, D per point) with their nearest
+# centroid, writing into labels: a writable buffer of one byte per point
+# when K <= 256, otherwise of one C int per point
+def predict_bytes(libkmeans, kmeans, pixels, labels):
+  n = len(pixels) // kmeans.D
+  address = ctypes.addressof(ctypes.c_char.from_buffer(labels))
+
+  if not libkmeans.predict_bytes(ctypes.byref(kmeans), pixels,
+    ctypes.c_int64(n), ctypes.c_void_p(address),
+    ctypes.c_int(kmeans.K <= 256)):
+    raise MemoryError("Not enough memory to label the data")
 
 def update_clusters(libkmeans, kmeans):
   libkmeans.update_clusters(ctypes.byref(kmeans))
@@ -153,11 +274,105 @@ def update_clusters(libkmeans, kmeans):
 def get_convergence(libkmeans, kmeans):
   return libkmeans.get_convergence(ctypes.byref(kmeans))
 
+# error of the last assignment (before the centroids were updated)
+def get_inertia(libkmeans, kmeans):
+  return libkmeans.get_inertia(ctypes.byref(kmeans))
+
+def get_cluster_errors(libkmeans, kmeans):
+  errors = (ctypes.c_double * kmeans.K)()
+  libkmeans.get_cluster_errors(ctypes.byref(kmeans), errors)
+  return list(errors)
+
 def get_threshold(libkmeans, kmeans):
   return libkmeans.get_threshold(ctypes.byref(kmeans))
 
 def get_clusters(libkmeans, kmeans):
   return libkmeans.get_clusters(ctypes.byref(kmeans))
 
+# cluster index of each of the n data points from the last assignment
+def get_labels(libkmeans, kmeans, n):
+  return libkmeans.get_labels(ctypes.byref(kmeans))[0:n]
+
 def free_clusters(libkmeans, kmeans):
-  libkmeans.free_clusters(ctypes.byref(kmeans))
\ No newline at end of file
+  libkmeans.free_clusters(ctypes.byref(kmeans))
+
+# A k-means context that can be reused for any number of runs. The C
+# library only ever grows its buffers (labels, sums, centroids), and the
+# converted data buffer is kept here too, so after the largest image has
+# been seen nothing is allocated per run. The memory is released by close,
+# preferably through a with statement:
+#
+#   with Engine(libkmeans) as engine:
+#     for image in images:
+#       ...
+class Engine:
+  def __init__(self, libkmeans):
+    self.libkmeans = libkmeans
+    # a zeroed struct has no buffers yet
+    self.kmeans = CKMeans()
+    self.data = None
+    self.weights = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def __del__(self):
+    self.close()
+
+  # resets the parameters for a run over data_size points of D components
+  # (the buffers are kept); weights, if given, stay referenced until the
+  # next run
+  def init(self, K, T, metric, data_size, weights=None, D=3):
+    init(self.libkmeans, self.kmeans, K, T, metric, data_size, D)
+    self.weights = None
+
+    if weights is not None:
+      self.weights = set_weights(self.libkmeans, self.kmeans, weights)
+
+  # like to_c_data, but copies into a buffer kept for the next call. The
+  # result is a view of the first len(data) points of that buffer.
+  def to_c_data(self, data):
+    if isinstance(data, ctypes.Array):
+      return data
+
+    cdata = self.reserve(len(data), dimensions(data))
+    cdata[:] = data
+    return cdata
+
+  # the same for points given as D bytes each, e.g. an image's tobytes().
+  # The conversion runs in C, without holding the GIL.
+  def from_bytes(self, pixels, D=3):
+    cdata = self.reserve(len(pixels) // D, D)
+    self.libkmeans.bytes_to_floats(pixels, ctypes.c_int64(len(pixels)),
+      as_points(cdata))
+    return cdata
+
+  # k of the points given as D bytes each, picked uniformly at random
+  # (seeded from Python's random) and returned as bytes in their order.
+  # Runs in C, without holding the GIL.
+  def sample_bytes(self, pixels, k, D=3):
+    out = ctypes.create_string_buffer(k * D)
+    set_seed(self.libkmeans, self.kmeans, random.getrandbits(32))
+    self.libkmeans.sample_bytes(ctypes.byref(self.kmeans), pixels,
+      ctypes.c_int64(len(pixels) // D), ctypes.c_int(D), ctypes.c_int64(k),
+      out)
+    return out.raw
+
+  # a view of n points of D components in the data buffer (grown if
+  # needed)
+  def reserve(self, n, D):
+    if self.data is None or len(self.data) < n * D:
+      self.data = None
+      self.data = (ctypes.c_float * (n * D))()
+
+    return ((ctypes.c_float * D) * n).from_buffer(self.data)
+
+  def close(self):
+    if self.libkmeans is not None:
+      free_clusters(self.libkmeans, self.kmeans)
+
+    self.data = None
+    self.weights = None
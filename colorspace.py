@@ -0,0 +1,215 @@
+"""
+  Perceptual color spaces for clustering
+
+  K-means on raw RGB treats every channel step as equally visible, which
+  it isn't, so low K palettes waste colors on differences nobody sees.
+  Clustering in CIELAB or OKLab fixes that. Both engines work on integer
+  3-tuples, so colors are converted into the chosen space and stored as
+  bytes, with the same scale on every channel. That way the Euclidean and
+  Manhattan distances stay proportional to distances in the space.
+
+  Images are converted through a 3D lookup table applied by PIL (trilinear
+  interpolation in C), so converting millions of pixels costs about as
+  much as a resize. The table is computed once per space. Interpolation
+  can't follow OKLab's cube root near black (CIELAB is linear there), so
+  in OKLab pixels darker than DARK in every channel go through a second
+  table covering only that corner.
+  Centroids are converted back to RGB from their unrounded values.
+"""
+
+import functools
+
+try:
+  from PIL import Image, ImageFilter, ImageChops
+except ImportError:
+  import Image
+  import ImageFilter
+  import ImageChops
+
+# color spaces
+RGB, Lab, OKLab = "rgb", "lab", "oklab"
+spaces = (RGB, Lab, OKLab)
+
+# per space: the value stored as byte 0 for each channel and the bytes per
+# unit, chosen so every sRGB color fits in 0-255
+encodings = {
+  Lab: ((0.0, -87.0, -108.0), 1.25),
+  OKLab: ((0.0, -0.24, -0.32), 255.0)
+}
+
+# number of grid points per side of the lookup table
+LUT_SIZE = 33
+# in the spaces of darkSpaces, pixels with every channel below DARK use
+# the dark corner's table, their bytes scaled by 256 / DARK to span it
+DARK = 32
+darkSpaces = (OKLab,)
+
+# sRGB (0-1) to linear light and back
+def linearize(c):
+  if c <= 0.04045:
+    return c / 12.92
+  return ((c + 0.055) / 1.055) ** 2.4
+
+def delinearize(c):
+  if c <= 0.0031308:
+    return c * 12.92
+  return 1.055 * c ** (1 / 2.4) - 0.055
+
+# signed cube root
+def cbrt(x):
+  return x ** (1.0 / 3) if x >= 0 else -(-x) ** (1.0 / 3)
+
+# CIELAB with a D65 white point
+def labF(t):
+  if t > (6.0 / 29) ** 3:
+    return t ** (1.0 / 3)
+  return t / (3 * (6.0 / 29) ** 2) + 4.0 / 29
+
+def labFInverse(t):
+  if t > 6.0 / 29:
+    return t ** 3
+  return 3 * (6.0 / 29) ** 2 * (t - 4.0 / 29)
+
+def linearToLab(r, g, b):
+  x = (0.4124564 * r + 0.3575761 * g + 0.1804375 * b) / 0.95047
+  y = 0.2126729 * r + 0.7151522 * g + 0.0721750 * b
+  z = (0.0193339 * r + 0.1191920 * g + 0.9503041 * b) / 1.08883
+
+  fx, fy, fz = labF(x), labF(y), labF(z)
+  return (116 * fy - 16, 500 * (fx - fy), 200 * (fy - fz))
+
+def labToLinear(L, a, b):
+  fy = (L + 16) / 116.0
+  x = labFInverse(fy + a / 500.0) * 0.95047
+  y = labFInverse(fy)
+  z = labFInverse(fy - b / 200.0) * 1.08883
+
+  return (3.2404542 * x - 1.5371385 * y - 0.4985314 * z,
+    -0.9692660 * x + 1.8760108 * y + 0.0415560 * z,
+    0.0556434 * x - 0.2040259 * y + 1.0572252 * z)
+
+# OKLab (Bjorn Ottosson, 2020)
+def linearToOKLab(r, g, b):
+  l = cbrt(0.4122214708 * r + 0.5363325363 * g + 0.0514459929 * b)
+  m = cbrt(0.2119034982 * r + 0.6806995451 * g + 0.1073969566 * b)
+  s = cbrt(0.0883024619 * r + 0.2817188376 * g + 0.6299787005 * b)
+
+  return (0.2104542553 * l + 0.7936177850 * m - 0.0040720468 * s,
+    1.9779984951 * l - 2.4285922050 * m + 0.4505937099 * s,
+    0.0259040371 * l + 0.7827717662 * m - 0.8086757660 * s)
+
+def oklabToLinear(L, a, b):
+  l = (L + 0.3963377774 * a + 0.2158037573 * b) ** 3
+  m = (L - 0.1055613458 * a - 0.0638541728 * b) ** 3
+  s = (L - 0.0894841775 * a - 1.2914855480 * b) ** 3
+
+  return (4.0767416621 * l - 3.3077115913 * m + 0.2309699292 * s,
+    -1.2684380046 * l + 2.6097574011 * m - 0.3413193965 * s,
+    -0.0041960863 * l - 0.7034186147 * m + 1.7076147010 * s)
+
+converters = {
+  Lab: (linearToLab, labToLinear),
+  OKLab: (linearToOKLab, oklabToLinear)
+}
+
+# sRGB (0-1) to the stored bytes as floats (0-255)
+def encode(space, r, g, b):
+  lows, scale = encodings[space]
+  values = converters[space][0](linearize(r), linearize(g), linearize(b))
+  return tuple([(v - lo) * scale for v, lo in zip(values, lows)])
+
+# stored bytes (may be fractional, e.g. a centroid) back to sRGB 0-255
+def decode(space, color):
+  lows, scale = encodings[space]
+  values = [c / scale + lo for c, lo in zip(color, lows)]
+  rgb = converters[space][1](*values)
+  return tuple([int(round(min(1.0, max(0.0, delinearize(c))) * 255))
+    for c in rgb])
+
+# the lookup table converting an RGB image into the space
+@functools.lru_cache(maxsize=None)
+def getLUT(space, size=LUT_SIZE):
+  return ImageFilter.Color3DLUT.generate(size,
+    lambda r, g, b: tuple([v / 255.0 for v in encode(space, r, g, b)]))
+
+# the same for the dark corner, whose input is scaled up to 0-255
+@functools.lru_cache(maxsize=None)
+def getDarkLUT(space, size=LUT_SIZE):
+  scale = 256.0 / DARK
+  return ImageFilter.Color3DLUT.generate(size,
+    lambda r, g, b: tuple([v / 255.0
+      for v in encode(space, r / scale, g / scale, b / scale)]))
+
+# lower (inclusive) and upper (exclusive) bounds of the stored values, for
+# seeding clusters
+@functools.lru_cache(maxsize=None)
+def getBounds(space):
+  if space == RGB:
+    return (0, 0, 0), (256, 256, 256)
+
+  table = getLUT(space).table
+  lower = [int(min(table[c::3]) * 255) for c in range(0, 3)]
+  upper = [int(max(table[c::3]) * 255) + 2 for c in range(0, 3)]
+  return tuple(lower), tuple([min(u, 256) for u in upper])
+
+# an RGB image converted into the space (stored as an RGB mode image)
+def convertImage(image, space):
+  if space == RGB:
+    return image
+
+  image = image.convert("RGB")
+  converted = image.filter(getLUT(space))
+  if space not in darkSpaces:
+    return converted
+
+  # white where every channel is dark
+  r, g, b = image.split()
+  mask = ImageChops.lighter(ImageChops.lighter(r, g), b).point(
+    lambda v: 255 if v < DARK else 0)
+  box = mask.getbbox()
+  if box is None:
+    return converted
+
+  dark = image.crop(box).point(lambda v: min(255, v * 256 // DARK))
+  converted.paste(dark.filter(getDarkLUT(space)), box, mask.crop(box))
+  return converted
+
+# a sequence of RGB colors converted into the space
+def convertColors(colors, space):
+  if space == RGB:
+    return colors
+
+  colors = tuple(colors)
+  image = Image.new("RGB", (len(colors), 1))
+  image.putdata(colors)
+  return tuple(convertImage(image, space).getdata())
+
+# several RGB images converted into the space with one pass through the
+# tables (each pass has a fixed cost, which dominates for thumbnails)
+def convertImages(images, space):
+  if space == RGB or len(images) < 2:
+    return [convertImage(image, space) for image in images]
+
+  # stacked one above the other
+  strip = Image.new("RGB", (max([image.size[0] for image in images]),
+    sum([image.size[1] for image in images])))
+  top = 0
+  for image in images:
+    strip.paste(image.convert("RGB"), (0, top))
+    top += image.size[1]
+
+  strip = convertImage(strip, space)
+  converted = []
+  top = 0
+  for image in images:
+    width, height = image.size
+    converted.append(strip.crop((0, top, width, top + height)))
+    top += height
+
+  return converted
+
+# a palette in the space converted back to RGB
+def toRGB(palette, space):
+  if space == RGB:
+    return list(palette)
+  return [decode(space, color) for color in palette]
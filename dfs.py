@@ -17,6 +17,20 @@
 
     CSCI 230 Final Project
 
+    10/18/2026 - version 1.1.0
+        region labeling in a single pass (labelRegions) with an array of
+        labels as the visited bitmap instead of searching lists
+        blocks are stored as flat arrays (BlockGrid) and averaged in one
+        pass; any block size works
+        neighbors come from constant position deltas per grid border
+        (GridAdjacency) and nothing uses module globals anymore, so images
+        can be segmented concurrently
+        multi-scale segmentation (segment): regions are found on a coarse
+        grid and only their boundaries are refined at finer block sizes;
+        the image, threshold and block sizes are now command line options
+        connected regions of a k-means label map with their statistics and
+        merging of small regions (findRegions)
+
     3/20/2014 - version 1.0.1
         added iterative version of traversePath() to avoid the recursive
         stack limit
@@ -29,28 +43,95 @@
 
 import time # measure execution time
 import math
+import re
+import collections
+import heapq
+import argparse # command line options
+from array import array # compact label storage
 from PIL import Image # for image display, pixel data, and crop
 
-BLOCK_SIZE = 2 # should be an even number
-image = None
-blocks = None
-
-# a block is a contiguous region of pixels
-class Block:
-    def __init__(self):
-        self.pixels = []
-        self.avg = self.position = self.x = self.y = 0
-
-    # adds a pixel to the internal list of pixels
-    def addPixel(self, pixel):
-        self.pixels.append(pixel)
-
-    def addPixelList(self, pixels):
-        self.pixels.extend(pixels)
-
-    # return a rounded average intensity of the block of pixels
-    def roundedAverage(self):
-        return int(round(sum(self.pixels) / float(len(self.pixels))))
+BLOCK_SIZE = 2 # any size works
+
+# the blocks (contiguous squares of pixels) of an image, stored as flat
+# arrays in row-major order rather than one object per block. A block's
+# position is its index into these arrays.
+# parents (optional) is a coarser grid and positions of its blocks: then
+# only the blocks inside those are averaged, into a dict by position.
+class BlockGrid:
+    def __init__(self, image, block_size, parents = None):
+        width, height = image.size
+
+        self.size = block_size
+        self.cols = width // block_size
+        self.rows = height // block_size
+
+        assert self.cols * block_size == width and \
+            self.rows * block_size == height, "crop with blockAdjustCrop"
+
+        # rounded average intensity of every block: box filtering the
+        # luminance buffer down by the block size does them all in one pass
+        # (in floating point so the rounding matches round() exactly)
+        if parents is None:
+            means = array("f",
+                image.convert("F").reduce(block_size).tobytes())
+            self.avg = array("B", [int(round(m)) for m in means])
+        else:
+            self.avg = {}
+            coarse, positions = parents
+            factor = coarse.size // block_size
+
+            for p in positions:
+                row, col = divmod(p, coarse.cols)
+                x, y = col * coarse.size, row * coarse.size
+                means = array("f", image.crop((x, y, x + coarse.size,
+                    y + coarse.size)).convert("F").reduce(
+                    block_size).tobytes())
+
+                first = row * factor * self.cols + col * factor
+                for i, m in enumerate(means):
+                    dy, dx = divmod(i, factor)
+                    self.avg[first + dy * self.cols + dx] = int(round(m))
+
+        # neighbors of every block (computed when asked for)
+        self.neighbors = GridAdjacency(self.cols, self.rows).neighbors
+
+    def __len__(self):
+        return self.cols * self.rows
+
+# the 8-neighborhood of the blocks of a cols x rows grid. The position
+# deltas of a block's neighbors only depend on which borders of the grid it
+# touches, so there is one constant list of deltas per combination of
+# borders (a mask) and nothing is stored per block.
+class GridAdjacency:
+    def __init__(self, cols, rows):
+        self.cols = cols
+        self.rows = rows
+
+        # border mask bits: 1 = first row, 2 = last row, 4 = first column,
+        # 8 = last column
+        self.deltas = [
+            tuple([dy * cols + dx
+                for dy in (-1, 0, 1)
+                for dx in (-1, 0, 1)
+                if (dx or dy) and
+                    not (mask & 1 and dy < 0) and
+                    not (mask & 2 and dy > 0) and
+                    not (mask & 4 and dx < 0) and
+                    not (mask & 8 and dx > 0)])
+            for mask in range(0, 16)
+        ]
+
+    # returns the neighbor positions of a block position
+    def neighbors(self, position):
+        row, col = divmod(position, self.cols)
+
+        if 0 < row < self.rows - 1 and 0 < col < self.cols - 1:
+            deltas = self.deltas[0]
+        else:
+            deltas = self.deltas[(row == 0) | (row == self.rows - 1) << 1 |
+                (col == 0) << 2 | (col == self.cols - 1) << 3]
+
+        return [position + d for d in deltas]
 
 # given image width and (x, y) in image, returns the intensity at that pixel
 # imageData expects a flattened list of intensity values
@@ -77,148 +158,565 @@ def blockAdjustCrop(image, block_size):
                        int(height)))
 
 def generateBlocks(image):
-    data = list(image.getdata())
-    width, height = image.size
-    blocks = []
-    block = Block()
-    position = 0
-
-    for col in range(0, width, BLOCK_SIZE):
-        for row in range(0, height):
-            if (row + 1) % BLOCK_SIZE == 0:
-                block.x = col
-                block.y = row
-                block.avg = block.roundedAverage()
-                block.position = position
-                blocks.append(block)
-                position += 1
-                block = Block()
-                continue
-
-            index = col + row * width
-            block.addPixelList(data[index : index + BLOCK_SIZE])
+    blocks = BlockGrid(image, BLOCK_SIZE)
 
     # length of blocks should be the area of image / area of block size
-    assert len(blocks) == width * height / BLOCK_SIZE ** 2
+    assert len(blocks) == image.size[0] * image.size[1] // BLOCK_SIZE ** 2
 
     return blocks
 
-# returns a list of neighbor blocks given a block object
-def getNeighbors(block):
-    global image, blocks
-    width, height = image.size
-
-    neighbors = []
-
-    rows = height / BLOCK_SIZE
-    col = math.floor(block.position / rows) * rows
-
-    # check all 8 directions for potential neighbors
-    left = block.position - rows
-    right = block.position + rows
-    top = block.position - 1
-    bottom = block.position + 1
-    top_right = right - 1
-    top_left = left - 1
-    bottom_right = right + 1
-    bottom_left = left + 1
-
-    if bottom < col + rows:
-        neighbors.append(blocks[bottom])
-    if right < len(blocks):
-        neighbors.append(blocks[right])
-        if top >= col:
-            neighbors.append(blocks[top_right])
-        if bottom < col + rows:
-            neighbors.append(blocks[bottom_right])
-    if left >= 0:
-        neighbors.append(blocks[left])
-        if top >= col:
-            neighbors.append(blocks[top_left])
-        if bottom < col + rows:
-            neighbors.append(blocks[bottom_left])
-    if top >= col:
-        neighbors.append(blocks[top])
+# returns the neighbor positions of a block position
+def getNeighbors(blocks, position):
+    return blocks.neighbors(position)
 
-    return neighbors
+# reduce a list of block positions based on a given threshold
+def reduceNeighbors(blocks, cells, orig_cell, threshold):
+    avg = blocks.avg
 
-# reduce a list of cells based on a given threshold
-def reduceNeighbors(cells, orig_cell, threshold):
     # use a list comprehension to remove necessary elements
-    return [x for x in cells if abs(x.avg - orig_cell.avg) < threshold]
+    return [x for x in cells if abs(avg[x] - avg[orig_cell]) < threshold]
 
 # recursive function that creates a subgraph from several path traversals
 # higher threshold => greater tolerance (more blocks matched)
-def traversePathRecursive(cell, orig_cell, visited = [], threshold = 127):
-    neighbors = reduceNeighbors(getNeighbors(cell), orig_cell, threshold)
+def traversePathRecursive(blocks, cell, orig_cell, visited = None,
+    threshold = 127):
+    if visited is None:
+        visited = set()
+
+    neighbors = reduceNeighbors(blocks, getNeighbors(blocks, cell), orig_cell,
+        threshold)
 
     path = [cell]
-    visited.append(cell.position)
+    visited.add(cell)
 
     for N in neighbors:
-        if N.position not in visited:
-            path += traversePath(N, orig_cell, visited, threshold)
+        if N not in visited:
+            path += traversePathRecursive(blocks, N, orig_cell, visited,
+                threshold)
 
     return path
 
 # same as above but an iterative version (to avoid recursion limit)
-def traversePathIterative(orig_cell, visited = [], threshold = 127):
+# blocks are marked visited when they're queued so none is queued twice
+def traversePathIterative(blocks, orig_cell, visited = None, threshold = 127):
+    if visited is None:
+        visited = set()
+
+    if orig_cell in visited:
+        return []
+
+    visited.add(orig_cell)
     neighbors = [orig_cell]
-    path = []
 
     for N in neighbors:
-        if N.position not in visited:
-            path.append(N)
-            visited.append(N.position)
-            neighbors += reduceNeighbors(getNeighbors(N), orig_cell, threshold)
+        for M in reduceNeighbors(blocks, getNeighbors(blocks, N), orig_cell,
+            threshold):
+            if M not in visited:
+                visited.add(M)
+                neighbors.append(M)
 
-    return path
+    return neighbors
 
-def main():
-    # open the image, convert it to greyscale, and crop it
-    # L stands for luminance
-    global image, blocks
+# label every block with the subgraph (region) it belongs to in one pass
+# over the blocks. Each region grows from the first unlabeled block (its
+# seed) to the connected blocks whose average is within threshold of the
+# seed's, the same as traversePathIterative. The label array doubles as
+# the visited bitmap (-1 = not visited yet).
+# returns the labels (indexed by block position) and the number of regions
+def labelRegions(blocks, threshold = 127):
+    avg = blocks.avg
+    neighbors = blocks.neighbors
+    labels = array("i", [-1]) * len(blocks)
+    numRegions = 0
+
+    for seed in range(0, len(blocks)):
+        if labels[seed] != -1:
+            continue
+
+        labels[seed] = numRegions
+        stack = [seed]
+
+        while stack:
+            position = stack.pop()
+
+            for N in neighbors(position):
+                if labels[N] == -1 and abs(avg[N] - avg[seed]) < threshold:
+                    labels[N] = numRegions
+                    stack.append(N)
+
+        numRegions += 1
 
-    image_color = Image.open("face.jpg")
-    image_color.show()
-    image = blockAdjustCrop(image_color.convert("L"), BLOCK_SIZE)
+    return labels, numRegions
+
+# positions of the blocks that touch a block with another label, out of
+# the given candidate positions
+def boundaryBlocks(blocks, labels, candidates):
+    neighbors = blocks.neighbors
+    boundary = []
+
+    for p in candidates:
+        label = labels[p]
+
+        for N in neighbors(p):
+            if labels[N] != label:
+                boundary.append(p)
+                break
+
+    return boundary
+
+# patterns matching a run of equal labels of one byte or one C int
+RUN_PATTERNS = {
+    1: re.compile(b"(.)\\1*", re.S),
+    4: re.compile(b"(.{4})\\1*", re.S)
+}
+
+# the runs of equal labels in labels[start:end] as (start, end) pairs. The
+# re module scans the raw label buffer, so there is a Python object per
+# run rather than per label. labels is a bytes-like object, or an array
+# of 1 or 4 byte items.
+def labelRuns(labels, start, end):
+    size = labels.itemsize if isinstance(labels, array) else 1
+
+    for match in RUN_PATTERNS[size].finditer(labels, start * size,
+        end * size):
+        yield match.start() // size, match.end() // size
+
+# labels of a cols x rows grid scaled up by factor (nearest neighbor)
+def upscaleLabels(labels, cols, rows, factor):
+    labelImage = Image.frombytes("I", (cols, rows),
+        array("i", labels).tobytes())
+    labelImage = labelImage.resize((cols * factor, rows * factor),
+        Image.NEAREST)
+
+    return array("i", labelImage.tobytes())
+
+# positions of the blocks a block splits into when the grid is refined
+def childBlocks(positions, cols, fineCols, factor):
+    children = []
 
-    # generate all of the blocks in the image
-    blocks = generateBlocks(image)
+    for p in positions:
+        row, col = divmod(p, cols)
+
+        for dy in range(0, factor):
+            first = (row * factor + dy) * fineCols + col * factor
+            children.extend(range(first, first + factor))
 
-    visited = []
-    subgraphs = []
-    width, height = image.size
-    area = width * height
+    return children
+
+# relabel the unlabeled (-1) blocks at the given positions: each joins the
+# neighboring region whose reference intensity is closest to its average
+# (and within threshold), spreading outward from the labeled blocks. Any
+# blocks left over grow new regions like labelRegions does, and their seed
+# averages are appended to reference.
+def relabelBlocks(blocks, labels, reference, positions, threshold):
+    avg = blocks.avg
+    neighbors = blocks.neighbors
+
+    queue = collections.deque(positions)
+
+    while queue:
+        p = queue.popleft()
+        if labels[p] != -1:
+            continue
+
+        best, bestDiff = -1, threshold
+
+        for N in neighbors(p):
+            label = labels[N]
+            if label != -1 and abs(avg[p] - reference[label]) < bestDiff:
+                best, bestDiff = label, abs(avg[p] - reference[label])
+
+        # try again once one of its neighbors is labeled
+        if best == -1:
+            continue
+
+        labels[p] = best
+
+        for N in neighbors(p):
+            if labels[N] == -1:
+                queue.append(N)
+
+    for seed in positions:
+        if labels[seed] != -1:
+            continue
+
+        labels[seed] = len(reference)
+        stack = [seed]
+
+        while stack:
+            p = stack.pop()
+
+            for N in neighbors(p):
+                if labels[N] == -1 and abs(avg[N] - avg[seed]) < threshold:
+                    labels[N] = len(reference)
+                    stack.append(N)
+
+        reference.append(avg[seed])
+
+# multi-scale segmentation: regions are grown on the coarsest grid (the
+# first block size), then at every finer block size only the blocks along
+# region boundaries are relabeled; all other blocks keep the label of the
+# larger block they're part of. Each block size must divide the previous.
+# returns the labels of the finest grid's blocks, the number of regions,
+# the finest grid and each region's reference intensity (its seed's average)
+def segment(image, blockSizes = (8, 4, 2), threshold = 61):
+    blockSizes = list(blockSizes)
+
+    for coarse, fine in zip(blockSizes, blockSizes[1:]):
+        if fine < 1 or coarse % fine:
+            raise ValueError("each block size must divide the one before it")
+
+    image = blockAdjustCrop(image.convert("L"), blockSizes[0])
+
+    blocks = BlockGrid(image, blockSizes[0])
+    labels, numRegions = labelRegions(blocks, threshold)
+
+    # each region's seed is its first block
+    reference = [-1] * numRegions
+    for position, label in enumerate(labels):
+        if reference[label] == -1:
+            reference[label] = blocks.avg[position]
+
+    refine = boundaryBlocks(blocks, labels, range(0, len(blocks)))
+
+    for level, size in enumerate(blockSizes[1:]):
+        factor = blocks.size // size
+        # only the blocks being relabeled are needed at this size
+        fine = BlockGrid(image, size, (blocks, refine))
+
+        labels = upscaleLabels(labels, blocks.cols, blocks.rows, factor)
+        unsettled = childBlocks(refine, blocks.cols, fine.cols, factor)
+
+        for p in unsettled:
+            labels[p] = -1
+
+        relabelBlocks(fine, labels, reference, unsettled, threshold)
+        blocks = fine
+
+        # only relabeled blocks and their neighbors can be on a boundary now
+        if level + 2 < len(blockSizes):
+            candidates = set(unsettled)
+            for p in unsettled:
+                candidates.update(getNeighbors(blocks, p))
+
+            refine = boundaryBlocks(blocks, labels, candidates)
+
+    # drop regions that were absorbed by their neighbors while refining
+    runs = list(labelRuns(labels, 0, len(labels)))
+    used = sorted(set([labels[start] for start, end in runs]))
+    if len(used) < len(reference):
+        remap = array("i", [-1]) * len(reference)
+        for i, label in enumerate(used):
+            remap[label] = i
+
+        for start, end in runs:
+            if remap[labels[start]] != labels[start]:
+                labels[start:end] = array("i",
+                    [remap[labels[start]]]) * (end - start)
+
+        reference = [reference[label] for label in used]
+
+    return labels, len(reference), blocks, reference
+
+# a connected area of pixels sharing one k-means label (see findRegions)
+class Region:
+    def __init__(self, label):
+        self.label = label
+        self.area = 0
+        # left, upper, right, lower (right and lower exclusive, as in crop)
+        self.bbox = None
+        # sum of the pixels' colors (for the mean color)
+        self.colorSum = [0, 0, 0]
+
+    def addRun(self, x, y, length):
+        self.area += length
+        bbox = self.bbox
+
+        if bbox is None:
+            self.bbox = [x, y, x + length, y + 1]
+        else:
+            # runs are added row by row, so y only grows
+            if x < bbox[0]:
+                bbox[0] = x
+            if x + length > bbox[2]:
+                bbox[2] = x + length
+            bbox[3] = y + 1
+
+    # absorb another region (e.g. a small one)
+    def merge(self, other):
+        self.area += other.area
+        bbox, otherBox = self.bbox, other.bbox
+        bbox[0:2] = min(bbox[0], otherBox[0]), min(bbox[1], otherBox[1])
+        bbox[2:4] = max(bbox[2], otherBox[2]), max(bbox[3], otherBox[3])
+
+        colorSum, otherSum = self.colorSum, other.colorSum
+        colorSum[0] += otherSum[0]
+        colorSum[1] += otherSum[1]
+        colorSum[2] += otherSum[2]
+
+    def meanColor(self):
+        return tuple([int(round(c / float(self.area))) for c in self.colorSum])
+
+# union-find root with path halving
+def findRoot(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+
+    return i
+
+# finds the connected regions of equal label in a label map (e.g. k-means
+# output, one label per pixel in row-major order) in one pass over the
+# rows. Rows are split into runs of equal label (see labelRuns) and only
+# runs are joined (union-find), so there are Python objects per run but
+# not per pixel. image (optional, RGB) is used for the regions' mean
+# colors. Regions smaller than minArea are merged into the neighbor they
+# share the longest border with and take its label: their pixels are
+# relabeled in labels, in place. connectivity is 4 or 8.
+# returns a region index per pixel (an array) and the list of Regions
+def findRegions(labels, width, height, image = None, minArea = 0,
+    connectivity = 4):
+    # reach of a run into the next row beyond its own columns
+    reach = 1 if connectivity == 8 else 0
+
+    # a buffer labelRuns can scan (labels itself unless it's e.g. a list)
+    data = labels
+    if not isinstance(labels, (bytes, bytearray)) and \
+        not (isinstance(labels, array) and labels.itemsize in (1, 4)):
+        data = array("i", labels)
+
+    # runs: first and last + 1 index into labels, and row
+    runStart, runEnd, runY = array("l"), array("l"), array("l")
+    parent = array("l")
+    # shared border length between pairs of runs with different labels
+    # (only needed for merging)
+    borders = {} if minArea > 1 else None
+
+    previous = []
+    for y in range(0, height):
+        rowStart = y * width
+        current = []
+
+        for start, end in labelRuns(data, rowStart, rowStart + width):
+            run = len(runStart)
+
+            runStart.append(start)
+            runEnd.append(end)
+            runY.append(y)
+            parent.append(run)
+
+            if borders is not None and current:
+                borders[current[-1], run] = 1
+            current.append(run)
+
+        # join touching runs of the previous row (both lists are sorted)
+        i, n = 0, len(previous)
+        for b in current:
+            bStart, bEnd = runStart[b] - width, runEnd[b] - width
+            bLabel = data[runStart[b]]
+
+            # runs ending before this one can't touch it or any later one
+            while i < n and runEnd[previous[i]] + reach <= bStart:
+                i += 1
+
+            k = i
+            while k < n and runStart[previous[k]] < bEnd + reach:
+                a = previous[k]
+
+                if data[runStart[a]] == bLabel:
+                    ra, rb = findRoot(parent, a), findRoot(parent, b)
+                    if ra != rb:
+                        parent[max(ra, rb)] = min(ra, rb)
+                elif borders is not None:
+                    # each pair of runs meets once
+                    borders[a, b] = max(1,
+                        min(runEnd[a], bEnd) - max(runStart[a], bStart))
+
+                k += 1
+
+        previous = current
+
+    if image is not None:
+        red, green, blue = [band.tobytes()
+            for band in image.convert("RGB").split()]
+
+    # one region per root run
+    regionOf = array("l", [-1]) * len(runStart)
+    regions = []
+
+    for run in range(0, len(runStart)):
+        root = parent[run]
+        if parent[root] != root:
+            root = findRoot(parent, root)
+        start, end, y = runStart[run], runEnd[run], runY[run]
+
+        if regionOf[root] == -1:
+            regionOf[root] = len(regions)
+            regions.append(Region(data[start]))
+
+        regionOf[run] = regionOf[root]
+        region = regions[regionOf[run]]
+        region.addRun(start - y * width, y, end - start)
+
+        if image is not None:
+            colorSum = region.colorSum
+            if end - start == 1:
+                colorSum[0] += red[start]
+                colorSum[1] += green[start]
+                colorSum[2] += blue[start]
+            else:
+                colorSum[0] += sum(red[start:end])
+                colorSum[1] += sum(green[start:end])
+                colorSum[2] += sum(blue[start:end])
+
+    if minArea > 1:
+        mergeRegions(regions, regionOf, borders, minArea)
+
+    # paint the region index of every run, and the new label of the runs
+    # of merged regions
+    regionMap = array("l", [0]) * (width * height)
+
+    for run in range(0, len(runStart)):
+        start, end = runStart[run], runEnd[run]
+        region = regionOf[run]
+
+        if end - start == 1:
+            regionMap[start] = region
+        else:
+            regionMap[start:end] = array("l", [region]) * (end - start)
+
+        label = regions[region].label
+        if label != data[start]:
+            fillLabels(labels, start, end, label)
+
+    return regionMap, regions
+
+# sets labels[start:end] to label whatever kind of sequence labels is
+def fillLabels(labels, start, end, label):
+    if isinstance(labels, bytearray):
+        labels[start:end] = bytes((label,)) * (end - start)
+    elif isinstance(labels, array):
+        labels[start:end] = array(labels.typecode, [label]) * (end - start)
+    else:
+        labels[start:end] = [label] * (end - start)
+
+# merges regions smaller than minArea into the neighbor they share the
+# longest border with (smallest first) and renumbers the rest; updates
+# regions and regionOf (region index of every run) in place
+def mergeRegions(regions, regionOf, borders, minArea):
+    # region adjacency with border lengths (plain dicts: there can be
+    # about as many regions as pixels)
+    neighbors = [{} for region in regions]
+    for (a, b), length in borders.items():
+        ra, rb = regionOf[a], regionOf[b]
+        if ra != rb:
+            neighbors[ra][rb] = neighbors[ra].get(rb, 0) + length
+            neighbors[rb][ra] = neighbors[rb].get(ra, 0) + length
+
+    parent = array("l", range(0, len(regions)))
+    heap = [(region.area, i) for i, region in enumerate(regions)
+        if region.area < minArea]
+    heapq.heapify(heap)
+
+    while heap:
+        area, i = heapq.heappop(heap)
+
+        # merged already, or grown since it was queued
+        if parent[i] != i or regions[i].area != area:
+            continue
+
+        adjacent = neighbors[i]
+        if not adjacent:
+            continue
+
+        # the longest border (the lowest index on ties)
+        longest = max(adjacent.values())
+        target = min([j for j, length in adjacent.items()
+            if length == longest])
+
+        regions[target].merge(regions[i])
+        parent[i] = target
+
+        # the target inherits the small region's borders
+        targetAdjacent = neighbors[target]
+        for j, length in adjacent.items():
+            del neighbors[j][i]
+            if j != target:
+                neighbors[j][target] = neighbors[j].get(target, 0) + length
+                targetAdjacent[j] = targetAdjacent.get(j, 0) + length
+        neighbors[i] = None
+
+        if regions[target].area < minArea:
+            heapq.heappush(heap, (regions[target].area, target))
+
+    # renumber the remaining regions
+    index = array("l", [-1]) * len(regions)
+    remaining = []
+    for i in range(0, len(regions)):
+        if parent[i] == i:
+            index[i] = len(remaining)
+            remaining.append(regions[i])
+
+    for run in range(0, len(regionOf)):
+        regionOf[run] = index[findRoot(parent, regionOf[run])]
+
+    regions[:] = remaining
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Partitions an image into regions of similar intensity.")
+    parser.add_argument("filename", nargs="?", default="face.jpg")
+    parser.add_argument("threshold", nargs="?", type=int, default=61,
+        help="higher threshold => less subgraphs (default 61)")
+    parser.add_argument("--block-sizes", default=str(BLOCK_SIZE),
+        metavar="SIZES",
+        help="comma separated, coarsest first, e.g. 8,4,2: regions are "
+            "found on the first grid and only their boundaries are refined "
+            "on the following ones (default %d)" % BLOCK_SIZE)
+    args = parser.parse_args()
+
+    try:
+        blockSizes = [int(size) for size in args.block_sizes.split(",")]
+    except ValueError:
+        print("Block sizes should be integers, e.g. 8,4,2")
+        return
+
+    # open the image (segment converts it to greyscale and crops it)
+    image_color = Image.open(args.filename)
+    image_color.show()
 
     ts = time.time()
 
-    for block in blocks:
-        if block.position not in visited:
-            subgraph = traversePathIterative(block, visited, 61)
-            subgraphs.append(subgraph)
-            print("# vertices in subgraph: %d (%.2f%% of graph)" % \
-                (len(subgraph),
-                len(subgraph) * BLOCK_SIZE**2 * 100 / float(area)))
+    labels, numRegions, blocks, reference = segment(image_color,
+        blockSizes, args.threshold)
+
+    area = len(blocks) * blocks.size ** 2
+
+    sizes = [0] * numRegions
+    for label in labels:
+        sizes[label] += 1
+
+    for size in sizes:
+        print("# vertices in subgraph: %d (%.2f%% of graph)" % \
+            (size, size * blocks.size**2 * 100 / float(area)))
 
     print("Total vertices in graph: " + str(len(blocks)))
     # a good number of subgraphs for an image might be around 2-10
     # modifying the threshold and weights will help achieve this
     # higher threshold => less subgraphs (more connected regions)
     # higher target weight => less subgraphs (not yet implemented)
-    print("Total subgraphs: " +  str(len(subgraphs)))
+    print("Total subgraphs: " +  str(numRegions))
 
     print("Execution time: %.4f seconds" % (time.time() - ts))
 
-    for subgraph in subgraphs:
-        for block in subgraph:
-            image.paste(subgraph[0].avg,
-                (block.x,
-                block.y - BLOCK_SIZE,
-                block.x + BLOCK_SIZE,
-                block.y - BLOCK_SIZE + BLOCK_SIZE))
+    # paint every block with its region's intensity: one pixel per block,
+    # scaled back up to the image size
+    regionImage = Image.frombytes("L", (blocks.cols, blocks.rows),
+        bytes([reference[label] for label in labels]))
+    image = regionImage.resize((blocks.cols * blocks.size,
+        blocks.rows * blocks.size), Image.NEAREST)
 
     image.show()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
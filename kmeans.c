@@ -9,42 +9,59 @@
   * C extension running through Python: 3.5314 seconds
 
   Compiled and linked using GCC 4.6.3 (32/64-bit on Linux):
-  gcc -m32 -fPIC -g -c -Wall kmeans.c
-  gcc -m32 -shared -Wl,-soname,kmeans.so.1 -o kmeans32.so kmeans.o -lc
-  gcc -m64 -fPIC -g -c -Wall kmeans.c
-  gcc -m64 -shared -Wl,-soname,kmeans.so.1 -o kmeans64.so kmeans.o -lc
+  gcc -m32 -fPIC -g -O3 -c -Wall kmeans.c
+  gcc -m32 -shared -Wl,-soname,kmeans.so.1 -o kmeans32.so kmeans.o -lc -lm
+  gcc -m64 -fPIC -g -O3 -c -Wall kmeans.c
+  gcc -m64 -shared -Wl,-soname,kmeans.so.1 -o kmeans64.so kmeans.o -lc -lm
 
   Written by Brandon Sachtleben
   CSCI 230 Final Project
 */
 
-#include <stdlib.h> /* abs */
-#include <stdint.h> /* uint32_t */
-#include <limits.h> /* UINT_MAX */
+#include <stdlib.h> /* malloc() */
+#include <math.h>   /* fabsf() */
+#include <float.h>  /* FLT_MAX */
+#include <stdint.h> /* uint32_t, int64_t */
 #include <string.h> /* memcpy() */
 #include <time.h>   /* time() */
 #include <stdio.h>  /* printf() */
 
-/* 3 component point struct */
-typedef struct {
-  int x;
-  int y;
-  int z;
-} Point;
+/* symbols have to be exported explicitly in the Windows DLL build */
+#ifdef _WIN32
+#define EXPORT __declspec(dllexport)
+#else
+#define EXPORT
+#endif
+
+/* the nearest-centroid kernels are compiled once per instruction set and
+   the best one for the CPU is picked when the library is loaded (GCC/Clang
+   function multiversioning, which needs ifunc support: x86-64 Linux) */
+#if defined(__x86_64__) && defined(__linux__) && defined(__has_attribute)
+#if __has_attribute(target_clones)
+#define DISPATCH __attribute__((target_clones("avx512f", "avx2", "default")))
+#endif
+#endif
+#ifndef DISPATCH
+#define DISPATCH
+#endif
 
 /* cluster struct */
 typedef struct {
-  /* data points */
-  int **points;
-  /* indices of data points */
-  int *indices;
-  /* centroids */
-  int *centroid;
-  int *prevCentroid;
+  /* centroids (D components each) */
+  float *centroid;
+  float *prevCentroid;
   /* number of data points */
-  int size;
+  int64_t size;
 } Cluster;
 
+/* distance between two points of D components */
+typedef float (*Distance)(const float*, const float*, int);
+
+/* distances from one point to all K centroids, given transposed (see
+   transpose_centroids) */
+typedef void (*Kernel)(const float *restrict, int, int,
+  const float *restrict, float *restrict);
+
 /* data needed for k-means algorithm */
 typedef struct {
   /* number of clusters */
@@ -53,150 +70,436 @@ typedef struct {
   float T;
   /* 0 = euclidean, 1 = manhattan */
   int metric;
-  /* number of data points */
-  int data_size;
-  /* distance function pointer */
-  int (*dist)(int*,int*);
-  /* upper and lower bounds of data */
-  int lower[3], upper[3];
+  /* number of data points (64-bit so images over 2^31 pixels work) */
+  int64_t data_size;
+  /* number of components of each point, e.g. 3 for RGB */
+  int D;
+  /* distance function pointer (specialized for D when possible) */
+  Distance dist;
+  /* lower (inclusive) and upper (exclusive) bounds of data, D each */
+  float *lower, *upper;
   /* clusters */
   Cluster *clusters;
+  /* optional number of occurrences of each data point (NULL = 1 each) */
+  int64_t *weights;
+  /* data last passed to assign_clusters/bisect_clusters (D floats per
+     point) */
+  float *data;
+  /* buffers: they only ever grow, so they're reused by every run with the
+     same or smaller data size, K and D until free_clusters is called */
+  /* cluster of each data point */
+  int *labels;
+  /* data indices grouped by cluster (bisecting) */
+  int64_t *order;
+  /* per cluster: sum of each component and the total weight */
+  double *sums;
+  /* current centroids followed by the previous ones */
+  float *centroids;
+  /* lower then upper bounds */
+  float *bounds;
+  /* sizes of the buffers above */
+  int64_t data_capacity;
+  int K_capacity;
+  int D_capacity;
+  /* state of this run's random number generator (rand() is shared by
+     every thread, this isn't) */
+  uint32_t seed;
+  /* sum of (weighted) distances of the points to their cluster in the
+     last assignment */
+  double inertia;
 } KMeans;
 
 /* euclidean distance */
 /* doesn't need the sqrt because it's all comparisons */
-int euclidean(int *a, int *b) {
-  return (a[0] - b[0]) * (a[0] - b[0]) +
-       (a[1] - b[1]) * (a[1] - b[1]) +
-       (a[2] - b[2]) * (a[2] - b[2]);
+EXPORT float euclidean(const float *a, const float *b, int D) {
+  float sum = 0, d;
+  int i;
+
+  for (i = 0; i < D; ++i) {
+    d = a[i] - b[i];
+    sum += d * d;
+  }
+
+  return sum;
 }
 
 /* manhattan distance */
-int manhattan(int *a, int *b) {
-  return abs(a[0] - b[0]) + abs(a[1] - b[1]) + abs(a[2] - b[2]);
+EXPORT float manhattan(const float *a, const float *b, int D) {
+  float sum = 0;
+  int i;
+
+  for (i = 0; i < D; ++i) {
+    sum += fabsf(a[i] - b[i]);
+  }
+
+  return sum;
+}
+
+/* the same with the number of components known at compile time, so the
+   loops are unrolled (and vectorized) for the common cases: 3 (RGB, Lab),
+   4 (RGBA) and 5 (RGB+XY) */
+#define FIXED_DISTANCES(N) \
+  float euclidean##N(const float *a, const float *b, int D) { \
+    float sum = 0, d; \
+    int i; \
+    (void)D; \
+    for (i = 0; i < N; ++i) { \
+      d = a[i] - b[i]; \
+      sum += d * d; \
+    } \
+    return sum; \
+  } \
+  float manhattan##N(const float *a, const float *b, int D) { \
+    float sum = 0; \
+    int i; \
+    (void)D; \
+    for (i = 0; i < N; ++i) { \
+      sum += fabsf(a[i] - b[i]); \
+    } \
+    return sum; \
+  }
+
+FIXED_DISTANCES(3)
+FIXED_DISTANCES(4)
+FIXED_DISTANCES(5)
+
+/* picks the distance function for a metric and number of components */
+Distance select_distance(int metric, int D) {
+  if (metric == 1) { /* Manhattan */
+    switch (D) {
+      case 3: return &manhattan3;
+      case 4: return &manhattan4;
+      case 5: return &manhattan5;
+      default: return &manhattan;
+    }
+  }
+
+  /* Euclidean */
+  switch (D) {
+    case 3: return &euclidean3;
+    case 4: return &euclidean4;
+    case 5: return &euclidean5;
+    default: return &euclidean;
+  }
+}
+
+/* the kernels: distances from point p to every centroid, written to
+   distances. Each loop runs over the clusters with the centroids stored
+   component by component, so it compiles to SIMD code (several clusters
+   per instruction) instead of one call through Distance per pair. */
+DISPATCH void euclidean_kernel(const float *restrict transposed, int K,
+  int D, const float *restrict p, float *restrict distances) {
+  float d;
+  int j, c;
+
+  for (j = 0; j < K; ++j) {
+    distances[j] = 0;
+  }
+
+  for (c = 0; c < D; ++c) {
+    for (j = 0; j < K; ++j) {
+      d = transposed[c*K + j] - p[c];
+      distances[j] += d * d;
+    }
+  }
+}
+
+DISPATCH void manhattan_kernel(const float *restrict transposed, int K,
+  int D, const float *restrict p, float *restrict distances) {
+  int j, c;
+
+  for (j = 0; j < K; ++j) {
+    distances[j] = 0;
+  }
+
+  for (c = 0; c < D; ++c) {
+    for (j = 0; j < K; ++j) {
+      distances[j] += fabsf(transposed[c*K + j] - p[c]);
+    }
+  }
+}
+
+/* with N components the component loop is unrolled and each distance is
+   written once */
+#define FIXED_KERNELS(N) \
+  DISPATCH void euclidean_kernel##N(const float *restrict transposed, \
+    int K, int D, const float *restrict p, float *restrict distances) { \
+    float sum, d; \
+    int j, c; \
+    (void)D; \
+    for (j = 0; j < K; ++j) { \
+      sum = 0; \
+      for (c = 0; c < N; ++c) { \
+        d = transposed[c*K + j] - p[c]; \
+        sum += d * d; \
+      } \
+      distances[j] = sum; \
+    } \
+  } \
+  DISPATCH void manhattan_kernel##N(const float *restrict transposed, \
+    int K, int D, const float *restrict p, float *restrict distances) { \
+    float sum; \
+    int j, c; \
+    (void)D; \
+    for (j = 0; j < K; ++j) { \
+      sum = 0; \
+      for (c = 0; c < N; ++c) { \
+        sum += fabsf(transposed[c*K + j] - p[c]); \
+      } \
+      distances[j] = sum; \
+    } \
+  }
+
+FIXED_KERNELS(3)
+FIXED_KERNELS(4)
+FIXED_KERNELS(5)
+
+/* picks the kernel for a metric and number of components */
+Kernel select_kernel(int metric, int D) {
+  if (metric == 1) { /* Manhattan */
+    switch (D) {
+      case 3: return &manhattan_kernel3;
+      case 4: return &manhattan_kernel4;
+      case 5: return &manhattan_kernel5;
+      default: return &manhattan_kernel;
+    }
+  }
+
+  /* Euclidean */
+  switch (D) {
+    case 3: return &euclidean_kernel3;
+    case 4: return &euclidean_kernel4;
+    case 5: return &euclidean_kernel5;
+    default: return &euclidean_kernel;
+  }
+}
+
+/* index of the smallest of K distances (the first one on ties) */
+int nearest(const float *distances, int K) {
+  int j, k = 0;
+
+  for (j = 1; j < K; ++j) {
+    if (distances[j] < distances[k]) {
+      k = j;
+    }
+  }
+
+  return k;
+}
+
+/* random number in [0, 2^31): an LCG step, whose state's low bits have
+   short periods, hashed (a murmur-style finalizer) so every output bit is
+   usable, e.g. by random_index's % n */
+int next_random(KMeans *kmeans) {
+  uint32_t x;
+
+  kmeans->seed = kmeans->seed * 1103515245u + 12345u;
+
+  x = kmeans->seed;
+  x ^= x >> 16;
+  x *= 0x7feb352du;
+  x ^= x >> 15;
+  x *= 0x846ca68bu;
+  x ^= x >> 16;
+
+  return x >> 1;
 }
 
-/* return random point within lower and upper bounds */
-Point generate_random_seed(KMeans *kmeans) {
-  Point p = {
-    kmeans->lower[0] + rand() % (kmeans->upper[0] - kmeans->lower[0]),
-    kmeans->lower[1] + rand() % (kmeans->upper[1] - kmeans->lower[1]),
-    kmeans->lower[2] + rand() % (kmeans->upper[2] - kmeans->lower[2])
-  };
-  return p;
+/* random point within lower and upper bounds */
+EXPORT void generate_random_seed(KMeans *kmeans, float *p) {
+  int i;
+
+  for (i = 0; i < kmeans->D; ++i) {
+    p[i] = kmeans->lower[i] + (kmeans->upper[i] - kmeans->lower[i]) *
+      (next_random(kmeans) / 2147483648.0f);
+  }
 }
 
 /* store some attributes for later use */
-void init(KMeans *kmeans, int K, float T, int metric, int data_size) {
+/* (the buffers are left alone so they can be reused) */
+EXPORT void init(KMeans *kmeans, int K, float T, int metric,
+  int64_t data_size, int D) {
   kmeans->K = K;
   kmeans->T = T;
   kmeans->metric = metric;
   kmeans->data_size = data_size;
+  kmeans->D = D;
+  kmeans->weights = NULL;
+  kmeans->data = NULL;
+  kmeans->dist = select_distance(metric, D);
 
-  switch (metric) {
-    case 0: /* Euclidean */
-      kmeans->dist = &euclidean;
-      break;
-    case 1: /* Manhattan */
-      kmeans->dist = &manhattan;
-      break;
-    default:
-      kmeans->dist = &euclidean;
+  /* set a seed for the random numbers (see set_seed) */
+  kmeans->seed = time(NULL);
+}
+
+/* seed the random numbers, e.g. differently for each of several runs
+   started at the same time */
+EXPORT void set_seed(KMeans *kmeans, uint32_t seed) {
+  kmeans->seed = seed;
+}
+
+EXPORT double get_inertia(KMeans *kmeans) {
+  return kmeans->inertia;
+}
+
+/* make sure the buffers fit data_size points and K clusters of D
+   components */
+/* returns 0 if memory couldn't be allocated */
+EXPORT int reserve(KMeans *kmeans) {
+  int D = kmeans->D, K = kmeans->K;
+  void *p;
+  int i;
+
+  if (kmeans->data_size > kmeans->data_capacity) {
+    p = realloc(kmeans->labels, sizeof(int) * kmeans->data_size);
+    if (!p) return 0;
+    kmeans->labels = p;
+
+    p = realloc(kmeans->order, sizeof(int64_t) * kmeans->data_size);
+    if (!p) return 0;
+    kmeans->order = p;
+
+    kmeans->data_capacity = kmeans->data_size;
+  }
+
+  if (K > kmeans->K_capacity) {
+    p = realloc(kmeans->clusters, sizeof(Cluster) * K);
+    if (!p) return 0;
+    kmeans->clusters = p;
   }
 
-  /* set a seed for rand */
-  srand(time(NULL));
+  if (K > kmeans->K_capacity || D > kmeans->D_capacity) {
+    if (K < kmeans->K_capacity) K = kmeans->K_capacity;
+    if (D < kmeans->D_capacity) D = kmeans->D_capacity;
+
+    p = realloc(kmeans->sums, sizeof(double) * (D + 1) * K);
+    if (!p) return 0;
+    kmeans->sums = p;
+
+    p = realloc(kmeans->centroids, sizeof(float) * 2 * D * K);
+    if (!p) return 0;
+    kmeans->centroids = p;
+
+    p = realloc(kmeans->bounds, sizeof(float) * 2 * D);
+    if (!p) return 0;
+    kmeans->bounds = p;
+
+    kmeans->K_capacity = K;
+    kmeans->D_capacity = D;
+  }
+
+  D = kmeans->D;
+  K = kmeans->K;
+
+  kmeans->lower = kmeans->bounds;
+  kmeans->upper = kmeans->bounds + D;
+
+  for (i = 0; i < K; ++i) {
+    kmeans->clusters[i].centroid = &kmeans->centroids[i*D];
+    kmeans->clusters[i].prevCentroid = &kmeans->centroids[(K + i)*D];
+    kmeans->clusters[i].size = 0;
+  }
+
+  return 1;
 }
 
-/* initialize clusters with lower and upper bounds */
-void init_clusters(KMeans *kmeans, int *lower, int *upper) {
-  memcpy(kmeans->lower, lower, sizeof(int) * 3);
-  memcpy(kmeans->upper, upper, sizeof(int) * 3);
+/* initialize clusters with lower and upper bounds (D each) */
+/* returns 0 if memory couldn't be allocated */
+EXPORT int init_clusters(KMeans *kmeans, float *lower, float *upper) {
+  int i, D = kmeans->D;
+
+  if (!reserve(kmeans)) {
+    return 0;
+  }
 
-  /* Create K clusters */
-  kmeans->clusters = malloc(sizeof(*kmeans->clusters) * kmeans->K);
+  memcpy(kmeans->lower, lower, sizeof(float) * D);
+  memcpy(kmeans->upper, upper, sizeof(float) * D);
 
   Cluster *clusters = kmeans->clusters;
 
-  int i;
   for (i = 0; i < kmeans->K; ++i) {
-    /* size = 0 */
-    clusters[i].size = 0;
-    clusters[i].points = NULL;
-    clusters[i].indices = NULL;
-
-    /* centroid */
-    clusters[i].centroid = malloc(sizeof(int) * 3);
-    clusters[i].prevCentroid = malloc(sizeof(int) * 3);
-
-    Point p = generate_random_seed(kmeans);
-    clusters[i].centroid[0] = clusters[i].prevCentroid[0] = p.x;
-    clusters[i].centroid[1] = clusters[i].prevCentroid[1] = p.y;
-    clusters[i].centroid[2] = clusters[i].prevCentroid[2] = p.z;
+    generate_random_seed(kmeans, clusters[i].centroid);
+    memcpy(clusters[i].prevCentroid, clusters[i].centroid,
+      sizeof(float) * D);
   }
+
+  return 1;
 }
 
-Cluster *get_clusters(KMeans *kmeans) {
+EXPORT Cluster *get_clusters(KMeans *kmeans) {
   return kmeans->clusters;
 }
 
-float get_threshold(KMeans *kmeans) {
+EXPORT int *get_labels(KMeans *kmeans) {
+  return kmeans->labels;
+}
+
+EXPORT float get_threshold(KMeans *kmeans) {
   return kmeans->T;
 }
 
-float get_convergence(KMeans *kmeans) {
-  int i, sum = 0;
+EXPORT double get_convergence(KMeans *kmeans) {
+  double sum = 0;
+  int i;
 
   for (i = 0; i < kmeans->K; ++i) {
     sum += euclidean(
       kmeans->clusters[i].centroid,
-      kmeans->clusters[i].prevCentroid
+      kmeans->clusters[i].prevCentroid,
+      kmeans->D
     );
   }
 
   return sum;
 }
 
-void clear_clusters(KMeans *kmeans) {
-  /* clear/free only the points */
-  int i, j;
+EXPORT void clear_clusters(KMeans *kmeans) {
+  int i;
 
-  Cluster *clusters = kmeans->clusters;
+  memset(kmeans->sums, 0, sizeof(double) * (kmeans->D + 1) * kmeans->K);
 
   for (i = 0; i < kmeans->K; ++i) {
-    for (j = 0; j < clusters[i].size; ++j) {
-      free(clusters[i].points[j]);
-    }
-
-    free(clusters[i].points);
-    free(clusters[i].indices);
-
-    clusters[i].points = NULL;
-    clusters[i].indices = NULL;
-    clusters[i].size = 0;
+    kmeans->clusters[i].size = 0;
   }
 }
 
-void compute_centroid(Cluster cluster) {
-  int r = 0, g = 0, b = 0;
-  int i;
+/* weight each data point, e.g. by its count in a color histogram */
+/* the array must stay valid until the clusters are freed */
+EXPORT void set_weights(KMeans *kmeans, int64_t *weights) {
+  kmeans->weights = weights;
+}
 
-  for (i = 0; i < cluster.size; ++i) {
-    r += cluster.points[i][0];
-    g += cluster.points[i][1];
-    b += cluster.points[i][2];
+/* add a data point to a cluster's sums */
+void add_point(KMeans *kmeans, int k, int64_t i) {
+  int c, D = kmeans->D;
+  double *sums = &kmeans->sums[k*(D + 1)];
+  float *p = &kmeans->data[i*D];
+  /* double sums: a float runs out of precision long before 2^31 pixels */
+  double w = kmeans->weights ? kmeans->weights[i] : 1;
+
+  for (c = 0; c < D; ++c) {
+    sums[c] += p[c] * w;
   }
+  sums[D] += w;
+  ++kmeans->clusters[k].size;
+}
+
+/* new centroid of cluster k from its sums */
+EXPORT void compute_centroid(KMeans *kmeans, int k) {
+  Cluster *cluster = &kmeans->clusters[k];
+  int c, D = kmeans->D;
+  double *sums = &kmeans->sums[k*(D + 1)];
 
   /* save old centroid */
-  memcpy(cluster.prevCentroid, cluster.centroid, sizeof(int) * 3);
+  memcpy(cluster->prevCentroid, cluster->centroid, sizeof(float) * D);
 
   /* new centroid */
-  cluster.centroid[0] = r / cluster.size;
-  cluster.centroid[1] = g / cluster.size;
-  cluster.centroid[2] = b / cluster.size;
+  for (c = 0; c < D; ++c) {
+    cluster->centroid[c] = sums[c] / sums[D];
+  }
 }
 
-void update_clusters(KMeans *kmeans) {
+EXPORT void update_clusters(KMeans *kmeans) {
   int i;
 
   Cluster *clusters = kmeans->clusters;
@@ -206,73 +509,419 @@ void update_clusters(KMeans *kmeans) {
       printf("Found an empty cluster (reassigning).\n");
 
       /* new centroid */
-      Point p = generate_random_seed(kmeans);
-      clusters[i].centroid[0] = clusters[i].prevCentroid[0] = p.x;
-      clusters[i].centroid[1] = clusters[i].prevCentroid[1] = p.y;
-      clusters[i].centroid[2] = clusters[i].prevCentroid[2] = p.z;
+      generate_random_seed(kmeans, clusters[i].centroid);
+      memcpy(clusters[i].prevCentroid, clusters[i].centroid,
+        sizeof(float) * kmeans->D);
     } else {
-      compute_centroid(clusters[i]);
+      compute_centroid(kmeans, i);
     }
   }
 }
 
-void free_clusters(KMeans *kmeans) {
-  int i, j;
+/* release all buffers (safe to call more than once) */
+EXPORT void free_clusters(KMeans *kmeans) {
+  free(kmeans->clusters);
+  free(kmeans->labels);
+  free(kmeans->order);
+  free(kmeans->sums);
+  free(kmeans->centroids);
+  free(kmeans->bounds);
+
+  kmeans->clusters = NULL;
+  kmeans->labels = NULL;
+  kmeans->order = NULL;
+  kmeans->sums = NULL;
+  kmeans->centroids = NULL;
+  kmeans->bounds = NULL;
+  kmeans->lower = kmeans->upper = NULL;
+  kmeans->data_capacity = 0;
+  kmeans->K_capacity = 0;
+  kmeans->D_capacity = 0;
+}
 
-  Cluster *clusters = kmeans->clusters;
+/* convert n bytes (e.g. the pixels of an 8-bit image) to floats, the data
+   layout the functions here take */
+EXPORT void bytes_to_floats(const unsigned char *bytes, int64_t n,
+  float *out) {
+  int64_t i;
 
-  for (i = 0; i < kmeans->K; ++i) {
-    for (j = 0; j < clusters[i].size; ++j) {
-      free(clusters[i].points[j]);
+  for (i = 0; i < n; ++i) {
+    out[i] = bytes[i];
+  }
+}
+
+/* pick k of the n points of D bytes each, uniformly at random and in
+   order (selection sampling, Knuth's algorithm S), copying them to out */
+EXPORT void sample_bytes(KMeans *kmeans, const unsigned char *bytes,
+  int64_t n, int D, int64_t k, unsigned char *out) {
+  int64_t i, chosen = 0;
+  double u;
+
+  for (i = 0; i < n && chosen < k; ++i) {
+    u = (next_random(kmeans) * 2147483648.0 + next_random(kmeans)) /
+      4611686018427387904.0;
+
+    if ((n - i) * u < k - chosen) {
+      memcpy(&out[chosen*D], &bytes[i*D], D);
+      ++chosen;
     }
+  }
+}
+
+/* scratch memory for the kernels, allocated per call so it stays out of
+   the KMeans struct (which ckmeans.py mirrors): the centroids transposed
+   (component c of cluster j at c*K + j), followed by K distances and one
+   point of D components. Returns NULL if memory couldn't be allocated. */
+float *transpose_centroids(KMeans *kmeans) {
+  int j, c, K = kmeans->K, D = kmeans->D;
+  float *transposed = malloc(sizeof(float) * (D*K + K + D));
+
+  if (!transposed) {
+    return NULL;
+  }
 
-    free(clusters[i].points);
-    free(clusters[i].indices);
-    free(clusters[i].centroid);
-    free(clusters[i].prevCentroid);
+  for (j = 0; j < K; ++j) {
+    for (c = 0; c < D; ++c) {
+      transposed[c*K + j] = kmeans->clusters[j].centroid[c];
+    }
   }
 
-  free(clusters);
+  return transposed;
 }
 
-void assign_clusters(KMeans *kmeans, int *data) {
-  uint32_t minCentroid, centroidDist;
-  int i, j, k;
+EXPORT void assign_clusters(KMeans *kmeans, float *data) {
+  float minCentroid, centroidDist;
+  int64_t i;
+  int j, k, K = kmeans->K, D = kmeans->D;
+  double inertia = 0;
 
-  Cluster *clusters = kmeans->clusters;
+  Kernel kernel = select_kernel(kmeans->metric, D);
+  float *transposed = transpose_centroids(kmeans);
+  float *distances = transposed ? transposed + D*K : NULL;
+
+  kmeans->data = data;
 
   /* minimize the distance from the point to the cluster */
   for (i = 0; i < kmeans->data_size; ++i) {
-    minCentroid = UINT_MAX;
+    if (transposed) {
+      kernel(transposed, K, D, &data[i*D], distances);
+      k = nearest(distances, K);
+      minCentroid = distances[k];
+    } else {
+      /* no scratch memory: one centroid at a time */
+      minCentroid = FLT_MAX;
+      k = 0;
+
+      for (j = 0; j < K; ++j) {
+        centroidDist = kmeans->dist(kmeans->clusters[j].centroid,
+          &data[i*D], D);
+
+        if (centroidDist < minCentroid) {
+          minCentroid = centroidDist;
+          k = j;
+        }
+      }
+    }
 
-    for (j = 0; j < kmeans->K; ++j) {
-      centroidDist = kmeans->dist(clusters[j].centroid, &data[i*3]);
+    /* record the cluster and add the point to its sums */
+    kmeans->labels[i] = k;
+    add_point(kmeans, k, i);
+
+    inertia += (double)minCentroid *
+      (kmeans->weights ? kmeans->weights[i] : 1);
+  }
+
+  kmeans->inertia = inertia;
+  free(transposed);
+}
+
+/* label n points given as D bytes each (e.g. straight from an 8-bit
+   image) with their nearest centroid. labels gets one byte per point if
+   byte_labels is set (K <= 256), otherwise one int. Unlike
+   assign_clusters this leaves the clusters alone, so a palette fit on a
+   sample can label any number of chunks of the full data. Returns 0 if
+   memory couldn't be allocated. */
+EXPORT int predict_bytes(KMeans *kmeans, const unsigned char *pixels,
+  int64_t n, void *labels, int byte_labels) {
+  int64_t i;
+  int c, k, K = kmeans->K, D = kmeans->D;
+
+  Kernel kernel = select_kernel(kmeans->metric, D);
+  float *transposed = transpose_centroids(kmeans);
+  float *distances, *point;
+
+  if (!transposed) {
+    return 0;
+  }
+
+  distances = transposed + D*K;
+  point = distances + K;
+
+  for (i = 0; i < n; ++i) {
+    for (c = 0; c < D; ++c) {
+      point[c] = pixels[i*D + c];
+    }
+
+    kernel(transposed, K, D, point, distances);
+    k = nearest(distances, K);
+
+    if (byte_labels) {
+      ((unsigned char*)labels)[i] = k;
+    } else {
+      ((int*)labels)[i] = k;
+    }
+  }
+
+  free(transposed);
+
+  return 1;
+}
+
+/* random index in [0, n), also for n larger than 2^31 */
+int64_t random_index(KMeans *kmeans, int64_t n) {
+  int64_t high = next_random(kmeans);
+  return ((high << 31) + next_random(kmeans)) % n;
+}
+
+/* sum of (weighted) distances of the points order[first..first+n) to a
+   centroid */
+double segment_error(KMeans *kmeans, int64_t first, int64_t n,
+  float *centroid) {
+  double error = 0;
+  int64_t i, idx, w = 1;
+  int D = kmeans->D;
+
+  for (i = first; i < first + n; ++i) {
+    idx = kmeans->order[i];
+
+    if (kmeans->weights) {
+      w = kmeans->weights[idx];
+    }
+
+    error += (double)kmeans->dist(centroid, &kmeans->data[idx*D], D) * w;
+  }
+
+  return error;
+}
+
+/* error of each cluster (inertia is the sum of these) */
+EXPORT void get_cluster_errors(KMeans *kmeans, double *errors) {
+  int64_t i, w = 1;
+  int k, D = kmeans->D;
+
+  for (k = 0; k < kmeans->K; ++k) {
+    errors[k] = 0;
+  }
+
+  for (i = 0; i < kmeans->data_size; ++i) {
+    k = kmeans->labels[i];
+
+    if (kmeans->weights) {
+      w = kmeans->weights[i];
+    }
+
+    errors[k] += (double)kmeans->dist(kmeans->clusters[k].centroid,
+      &kmeans->data[i*D], D) * w;
+  }
+}
+
+/* 2-means over the points order[first..first+n) of cluster parent,
+   moving one half to the end of the range and into the (empty) cluster
+   child. Seeded with a random point and the point farthest from it. The
+   labels buffer holds which half each point is in meanwhile. Returns the
+   number of points moved (-1 if memory couldn't be allocated). */
+int64_t split_cluster(KMeans *kmeans, int parent, int child, int64_t first,
+  int64_t n, int passes) {
+  int D = kmeans->D;
+  /* two sets of: D sums and the total weight */
+  double *sums = malloc(sizeof(double) * 2 * (D + 1));
+  float *seeds = malloc(sizeof(float) * 2 * D);
+  int64_t i, j, idx, far = first, moved;
+  int64_t *order = kmeans->order;
+  float *data = kmeans->data;
+  int *labels = kmeans->labels;
+  float d, farthest = 0;
+  double w = 1;
+  int pass, s, c, changed;
+  float *firstSeed;
+
+  if (!sums || !seeds) {
+    free(sums);
+    free(seeds);
+    return -1;
+  }
 
-      if (centroidDist < minCentroid) {
-        minCentroid = centroidDist;
-        k = j;
+  /* seeds */
+  firstSeed = &data[order[first + random_index(kmeans, n)]*D];
+
+  for (i = first; i < first + n; ++i) {
+    d = kmeans->dist(firstSeed, &data[order[i]*D], D);
+
+    if (d > farthest) {
+      farthest = d;
+      far = i;
+    }
+  }
+
+  memcpy(&seeds[0], firstSeed, sizeof(float) * D);
+  memcpy(&seeds[D], &data[order[far]*D], sizeof(float) * D);
+
+  for (pass = 0; pass < passes; ++pass) {
+    memset(sums, 0, sizeof(double) * 2 * (D + 1));
+    changed = 0;
+
+    for (i = first; i < first + n; ++i) {
+      idx = order[i];
+      s = kmeans->dist(&seeds[D], &data[idx*D], D) <
+        kmeans->dist(&seeds[0], &data[idx*D], D);
+
+      if (pass == 0 || labels[idx] != s) {
+        changed = 1;
+      }
+
+      labels[idx] = s;
+
+      if (kmeans->weights) {
+        w = kmeans->weights[idx];
+      }
+
+      for (c = 0; c < D; ++c) {
+        sums[s*(D + 1) + c] += data[idx*D + c] * w;
+      }
+      sums[s*(D + 1) + D] += w;
+    }
+
+    if (!changed || sums[D] == 0 || sums[2*D + 1] == 0) {
+      break;
+    }
+
+    for (s = 0; s < 2; ++s) {
+      for (c = 0; c < D; ++c) {
+        seeds[s*D + c] = sums[s*(D + 1) + c] / sums[s*(D + 1) + D];
+      }
+    }
+  }
+
+  /* partition the range: first half, then second half */
+  for (i = first, j = first + n - 1; i <= j; ) {
+    if (labels[order[i]] == 0) {
+      ++i;
+    } else {
+      idx = order[i];
+      order[i] = order[j];
+      order[j] = idx;
+      --j;
+    }
+  }
+
+  moved = first + n - i;
+
+  if (moved > 0 && moved < n) {
+    /* the last pass' sums belong to this partition */
+    memcpy(&kmeans->sums[parent*(D + 1)], &sums[0],
+      sizeof(double) * (D + 1));
+    memcpy(&kmeans->sums[child*(D + 1)], &sums[D + 1],
+      sizeof(double) * (D + 1));
+    kmeans->clusters[parent].size = n - moved;
+    kmeans->clusters[child].size = moved;
+
+    compute_centroid(kmeans, parent);
+    compute_centroid(kmeans, child);
+  } else {
+    moved = 0;
+  }
+
+  free(sums);
+  free(seeds);
+
+  return moved;
+}
+
+/* bisecting (divisive) k-means: starting from one cluster holding all of
+   the data, split the cluster with the largest error in two until there
+   are K clusters. Each split only touches that cluster's points, so this
+   takes about N*log(K) distance computations instead of N*K per pass.
+   Leaves the data assigned; clusters that couldn't be filled (fewer
+   distinct points than K) keep their random seeds. Returns 0 if memory
+   couldn't be allocated. */
+EXPORT int bisect_clusters(KMeans *kmeans, float *data, int passes) {
+  double *error = malloc(sizeof(double) * kmeans->K);
+  int64_t *first = malloc(sizeof(int64_t) * kmeans->K);
+  int64_t i, n = kmeans->data_size, moved = 0;
+  int j, c, m;
+
+  Cluster *clusters = kmeans->clusters;
+
+  kmeans->data = data;
+  clear_clusters(kmeans);
+
+  if (n == 0 || !error || !first) {
+    free(error);
+    free(first);
+    return n == 0;
+  }
+
+  /* start with every point in the first cluster */
+  for (i = 0; i < n; ++i) {
+    kmeans->order[i] = i;
+    add_point(kmeans, 0, i);
+  }
+
+  compute_centroid(kmeans, 0);
+  first[0] = 0;
+  error[0] = segment_error(kmeans, 0, n, clusters[0].centroid);
+
+  for (m = 1; m < kmeans->K; ) {
+    /* pick the cluster with the largest error */
+    c = 0;
+    for (j = 1; j < m; ++j) {
+      if (error[j] > error[c]) {
+        c = j;
       }
     }
 
-    int idx = clusters[k].size;
+    /* every cluster is a single color */
+    if (error[c] <= 0) {
+      break;
+    }
 
-    /* reallocate list of points so we can add one */
-    clusters[k].points = realloc(clusters[k].points,
-      sizeof(*clusters[k].points) * (idx + 1));
+    moved = split_cluster(kmeans, c, m, first[c], clusters[c].size, passes);
 
-    /* reallocate index list */
-    clusters[k].indices = realloc(clusters[k].indices,
-      sizeof(*clusters[k].indices) * (idx + 1));
+    if (moved < 0) {
+      break;
+    } else if (moved == 0) {
+      error[c] = 0;
+      continue;
+    }
 
-    /* allocate space for a point */
-    clusters[k].points[idx] = malloc(sizeof(int) * 3);
+    first[m] = first[c] + clusters[c].size;
+    error[c] = segment_error(kmeans, first[c], clusters[c].size,
+      clusters[c].centroid);
+    error[m] = segment_error(kmeans, first[m], clusters[m].size,
+      clusters[m].centroid);
+    ++m;
+  }
 
-    /* copy the point from the data set to the cluster */
-    memcpy(clusters[k].points[idx], &data[i*3], sizeof(int) * 3);
+  /* label every point with its cluster */
+  for (c = 0; c < m; ++c) {
+    for (i = first[c]; i < first[c] + clusters[c].size; ++i) {
+      kmeans->labels[kmeans->order[i]] = c;
+    }
+  }
+
+  free(error);
+  free(first);
 
-    /* record the index of the point */
-    clusters[k].indices[idx] = i;
+  return moved >= 0;
+}
+
+/* replace the first n centroids, e.g. with a previous solution */
+EXPORT void seed_clusters(KMeans *kmeans, float *seeds, int n) {
+  int i, D = kmeans->D;
 
-    ++clusters[k].size;
+  for (i = 0; i < n && i < kmeans->K; ++i) {
+    memcpy(kmeans->clusters[i].centroid, &seeds[i*D], sizeof(float) * D);
+    memcpy(kmeans->clusters[i].prevCentroid, &seeds[i*D],
+      sizeof(float) * D);
   }
-}
\ No newline at end of file
+}
@@ -38,14 +38,18 @@ class PyCluster:
     self.points.clear()
 
   # average all the attributes
-  def computeCentroid(self):
-    length = len(self.points)
+  # weights (optional) is indexed the same way as the data set, so each
+  # point counts as weights[p] points (e.g. a color histogram)
+  def computeCentroid(self, weights=None):
+    length = 0
 
     centroid = [0] * self.components
 
     for p in self.points:
+      w = 1 if weights is None else weights[p]
+      length += w
       for i in range(0, self.components):
-        centroid[i] += self.points[p][i]
+        centroid[i] += self.points[p][i] * w
 
     self.prevCentroid = self.centroid
     self.centroid = tuple([i / length for i in centroid])
@@ -55,7 +59,8 @@ class PyCluster:
   Contains the main implementation of the algorithm.
 """
 class PyKMeans:
-  def __init__(self, data, K=6, T=99, metric=Euclidean):
+  def __init__(self, data, K=6, T=99, metric=Euclidean, weights=None,
+    bounds=None):
     # number of clusters
     self.K = int(K)
     # threshold
@@ -71,6 +76,13 @@ class PyKMeans:
       self.components = len(self.data[0])
     # distance metric
     self.metric = metric
+    # number of occurrences of each data point (None = 1 each)
+    self.weights = weights
+    # (lowest, highest) value of each component, for random clusters
+    self.bounds = bounds or [(0, 255) for i in range(0, self.components)]
+    # sum of (weighted) distances of the points to their cluster in the
+    # last assignment
+    self.inertia = 0
 
   # accessors
   def getK(self):
@@ -88,6 +100,12 @@ class PyKMeans:
   def getMetric(self):
     return self.metric
 
+  def getWeights(self):
+    return self.weights
+
+  def getInertia(self):
+    return self.inertia
+
   # returns a cluster with random attributes
   # bounds is the upper and lower bounds of the data.
   # e.g. ((0, 255), (0, 255), (0, 255))
@@ -105,12 +123,7 @@ class PyKMeans:
   def assignClusters(self):
     # store the function so we don't have to use unnecessary if statements
     # in the loops.
-    if self.metric == Euclidean:
-      distance = getEuclideanDistance
-    elif self.metric == Manhattan:
-      distance = getManhattanDistance
-    else:
-      distance = getEuclideanDistance
+    distance = getDistanceFunction(self.metric)
 
     # float("Inf") is not considered portable, so I'm using try/except
     # it throws an error on some systems and versions of Python
@@ -119,6 +132,8 @@ class PyKMeans:
     except:
       largeValue = 1e30000
 
+    self.inertia = 0
+
     for i, p in enumerate(self.data):
       # initial value to be minimized
       minAttr = largeValue
@@ -130,6 +145,9 @@ class PyKMeans:
           k = c
       k.points[i] = p
 
+      self.inertia += minAttr * (1 if self.weights is None else
+        self.weights[i])
+
   # clear all data points in clusters
   def clearClusters(self):
     [k.clearPixels() for k in self.clusters]
@@ -141,11 +159,99 @@ class PyKMeans:
       # to be handled on reassignment
       if len(k.points) == 0:
         print("Found an empty cluster (reassigning).")
-        k.prevCentroid = k.centroid = self.generateRandomCluster([
-          (0, 255) for i in range(0, self.components)
-        ])
+        k.prevCentroid = k.centroid = self.generateRandomCluster(
+          self.bounds)
       else:
-        k.computeCentroid()
+        k.computeCentroid(self.weights)
+
+  # bisecting (divisive) k-means: starting from one cluster holding all of
+  # the data, split the cluster with the largest error in two with a
+  # 2-means step over only its own points until there are K clusters. This
+  # takes about N*log(K) distance computations instead of N*K per pass.
+  # passes is the maximum number of 2-means iterations per split.
+  def bisectClusters(self, passes=10):
+    distance = getDistanceFunction(self.metric)
+
+    root = PyCluster(self.data[0])
+    root.points = dict(enumerate(self.data))
+    root.computeCentroid(self.weights)
+
+    clusters = [root]
+    errors = [self.getClusterError(root, distance)]
+
+    while len(clusters) < self.K:
+      # split the worst cluster (nothing left to split if they're all 0)
+      c = errors.index(max(errors))
+      if errors[c] <= 0:
+        break
+
+      a, b = self.splitCluster(clusters[c], distance, passes)
+
+      if len(a.points) == 0:
+        a, b = b, a
+
+      if len(b.points) == 0:
+        errors[c] = 0
+        continue
+
+      clusters[c] = a
+      clusters.append(b)
+      errors[c] = self.getClusterError(a, distance)
+      errors.append(self.getClusterError(b, distance))
+
+    # too few distinct points: fill up with random clusters
+    while len(clusters) < self.K:
+      clusters.append(PyCluster(self.generateRandomCluster(self.bounds)))
+
+    self.clusters = clusters
+
+  # 2-means over the points of one cluster, seeded with a random point and
+  # the point farthest from it. Returns the two halves.
+  def splitCluster(self, cluster, distance, passes):
+    points = cluster.points
+    first = points[random.choice(list(points))]
+    second = max(points.values(),
+      key=lambda p: distance(first, p, self.components))
+
+    a, b = PyCluster(first), PyCluster(second)
+
+    for i in range(0, passes):
+      a.clearPixels()
+      b.clearPixels()
+
+      for j, p in points.items():
+        if distance(b.centroid, p, self.components) < \
+          distance(a.centroid, p, self.components):
+          b.points[j] = p
+        else:
+          a.points[j] = p
+
+      if len(a.points) == 0 or len(b.points) == 0:
+        break
+
+      a.computeCentroid(self.weights)
+      b.computeCentroid(self.weights)
+
+      # assignments didn't change
+      if a.centroid == a.prevCentroid and b.centroid == b.prevCentroid:
+        break
+
+    return a, b
+
+  # sum of (weighted) distances of a cluster's points to its centroid
+  def getClusterError(self, cluster, distance):
+    error = 0
+
+    for i, p in cluster.points.items():
+      w = 1 if self.weights is None else self.weights[i]
+      error += distance(cluster.centroid, p, self.components) * w
+
+    return error
+
+  # error of each cluster (inertia is the sum of these)
+  def getClusterErrors(self):
+    distance = getDistanceFunction(self.metric)
+    return [self.getClusterError(k, distance) for k in self.clusters]
 
   # returns convergence of the algorithm
   def getConvergence(self):
@@ -154,6 +260,13 @@ class PyKMeans:
       for k in self.clusters
     ]))
 
+# returns the distance function for a metric (Euclidean by default)
+def getDistanceFunction(metric):
+  if metric == Manhattan:
+    return getManhattanDistance
+
+  return getEuclideanDistance
+
 # returns Euclidean distance between two positions (element length = n)
 def getEuclideanDistance(a, b, n):
   return sum([(b[i] - a[i])**2 for i in range(0, n)])
@@ -81,17 +81,26 @@
 hasTk = hasImageTk = hasTkDialog = True
 
 import sys      # for command line arguments
+import argparse # for command line options
 import time     # to track running time
 import os       # for file path, detecting OS
 import gc
+import collections
+import random
+import math
+import array
+import threading
+import queue
+import concurrent.futures # for running restarts in parallel
 
 # some of these modules didn't exist on the machines I've tested so I
 # try to provide alternatives if possible.
 try:
   import Image
+  import ImageSequence
 except ImportError:
   try:
-    from PIL import Image
+    from PIL import Image, ImageSequence
   except:
     print("PIL (Python Imaging Library) or Pillow is required " \
       "for this program to run.")
@@ -119,6 +128,10 @@ except ImportError:
 from pykmeans import *
 # c version
 import ckmeans
+# connected regions of the result
+import dfs
+# perceptual color spaces to cluster in
+import colorspace
 
 # start with the python version
 KMeans = PyKMeans
@@ -143,16 +156,54 @@ else:
   useCLib = False
   print("Using Python implementation")
 
+# the palette is fit on at most this many pixels (about what the image
+# used to be scaled down to) and then every pixel is labeled with it
+SAMPLE_SIZE = 600 * 600
+sampleModes = ("random", "grid")
+
 """
   Quantizer:
   Encapsulates the program's GUI and main application of k-means
 """
 class Quantizer:
   def __init__(self, filename=None, resize=True, K=8, T=99,
-         metric=Euclidean, gui=True):
+         metric=Euclidean, gui=True, allFrames=False, bisect=False,
+         refine=True, sweep=None, targetError=None, outputPath=None,
+         compressLevel=6, saveInput=True, regions=False, minRegionArea=0,
+         nInit=1, workers=None, space=colorspace.RGB, sampleMode="random",
+         sampleSize=SAMPLE_SIZE):
     self.gui = gui
-    self.resize = resize
+    # the palette is fit on this many pixels (None, or resize=False, = all
+    # of them), which are picked by sampleMode (see samplePixels)
+    self.sampleSize = sampleSize if resize else None
+    self.sampleMode = sampleMode
+    # quantize all frames of an animated image to one shared palette
+    self.allFrames = allFrames
+    # bisecting k-means, optionally followed by the usual passes
+    self.bisect = bisect
+    self.refine = refine
+    # range of K to try (K is then picked automatically)
+    self.sweep = sweep
+    self.targetError = targetError
+    # where and how to write the result (format from the extension)
+    self.outputPath = outputPath or "output.png"
+    self.framesOutputPath = outputPath or "output.gif"
+    self.compressLevel = compressLevel
+    # save a copy of the input next to the output when it can't be shown
+    self.saveInput = saveInput
+    # report connected regions, merging those under minRegionArea pixels
+    self.regions = regions or minRegionArea > 1
+    self.minRegionArea = minRegionArea
+    # number of restarts to pick the best of, and how many run at once
+    self.nInit = nInit
+    self.workers = workers
+    # color space to cluster in (see colorspace)
+    self.space = space
     self.imageWindows = []
+    # C buffers reused by every run (sized to the largest image so far)
+    self.engine = ckmeans.Engine(libkmeans) if useCLib else None
+    # one per restart worker (the first is self.engine)
+    self.engines = [self.engine] if useCLib else None
 
     if gui:
       self.window = tk.Tk()
@@ -274,6 +325,15 @@ class Quantizer:
       K = self.K
       T = self.T
 
+    # multi-frame images are written straight to disk (no display)
+    if self.allFrames:
+      quantizeFrames(filename, K, T, metric, self.framesOutputPath,
+        bisect=self.bisect, refine=self.refine,
+        compressLevel=self.compressLevel, engine=self.engine,
+        nInit=self.nInit, workers=self.workers, engines=self.engines,
+        space=self.space)
+      return
+
     # load and display the source image
     try:
       inputImage = Image.open(filename)
@@ -284,116 +344,89 @@ class Quantizer:
     # guarantee the image is in RGB mode
     inputImage = inputImage.convert("RGB")
 
-    # resize if necessary
     width, height = inputImage.size
-
-    if self.resize and (width > 600 or height > 600):
-      if width > height:
-        height = int(height * 600.0 / width)
-        width = 600
-      else:
-        width = int(width * 600.0 / height)
-        height = 600
-
-      inputImage = inputImage.resize((width, height), Image.BILINEAR)
-      print("Image scaled to %dx%d" % (width, height))
-    else:
-      print("Image resolution: %dx%d" % (width, height))
-
-    # get a flattened list of the image data
-    data = tuple(inputImage.getdata())
-
-    # initialize k-means with given parameters
-    if not useCLib:
-      kmeans = KMeans(data, K, T, metric=metric)
-    else:
-      kmeans = KMeans()
-      ckmeans.init(libkmeans, kmeans, K, T, metric, len(data))
+    print("Image resolution: %dx%d" % (width, height))
 
     # track execution time
     ts = time.time()
 
-    # generate K clusters with some initial attributes
-    print("Generating initial %d clusters..." % K)
-
-    if not useCLib:
-      seeds = []
-      for k in range(0, K):
-        seeds.append(kmeans.generateRandomCluster(tuple([
-            (0, 255) for b in range(0, 3)
-        ])))
-
-      kmeans.seedClusters(seeds)
+    # get the image data (or a sample of it, labeled at full resolution
+    # afterwards) in the clustering space
+    data, sampled = imageData(inputImage, self.space, self.engine,
+      self.sampleSize, self.sampleMode)
+    if sampled:
+      print("Fitting on a %s sample of %d pixels" % (self.sampleMode,
+        len(data)))
+
+    bounds = colorspace.getBounds(self.space)
+
+    if self.sweep:
+      curve, K = sweepK(data, self.sweep, T, metric,
+        targetError=self.targetError, engine=self.engine, bounds=bounds)
+
+      print("K\tmean error")
+      for k, error, palette in curve:
+        print("%d\t%.2f" % (k, error))
+      print("Suggested K=%d" % K)
+
+      # the sweep already found this palette; a final run gets the labels
+      seeds = [palette for k, error, palette in curve if k == K][0]
+      if self.nInit > 1:
+        print("Ignoring nInit=%d: the sweep's palette seeds the final run."
+          % self.nInit)
     else:
-      ckmeans.init_clusters(libkmeans, kmeans,
-        (0, 0, 0), (256, 256, 256))
-
-    # this constant holds the maximum (Euclidean) distance between colors
-    maxDistance = K * 3 * 255**2
-    # has the algorithm converged?
-    converged = False
-    # number of passes
-    numPasses = 0
-
-    # repeat algorithm until sufficient convergence
-    while not converged:
-      print("Pass %d" % (numPasses + 1))
-      # clear pixel assignments in clusters
-      if not useCLib:
-        kmeans.clearClusters()
-      else:
-        ckmeans.clear_clusters(libkmeans, kmeans)
-
-      # assign each pixel to best cluster
-      print("1) Assigning pixels to clusters...")
-      if not useCLib:
-        kmeans.assignClusters()
-      else:
-        ckmeans.assign_clusters(libkmeans, kmeans, data)
+      seeds = None
 
-      # update clusters
-      print("2) Updating clusters...")
-      if not useCLib:
-        kmeans.updateClusters()
-      else:
-        ckmeans.update_clusters(libkmeans, kmeans)
-
-      # look at threshold to determine when to terminate the algorithm.
-      if not useCLib:
-        cPerc = (1 - kmeans.getConvergence() / maxDistance) * 100
-        if cPerc >= kmeans.getThreshold():
-          converged = True
-      else:
-        cPerc = (1 - ckmeans.get_convergence(libkmeans, kmeans) /
-          maxDistance) * 100
-        if cPerc >= ckmeans.get_threshold(libkmeans, kmeans):
-          converged = True
+    if self.nInit > 1 and seeds is None:
+      palette, labels, errors = runRestarts(data, K, T, metric,
+        n=self.nInit, workers=self.workers, bisect=self.bisect,
+        refine=self.refine, engines=self.engines, bounds=bounds,
+        roundPalette=self.space == colorspace.RGB)
+    else:
+      palette, labels, errors = runKMeans(data, K, T, metric,
+        bisect=self.bisect, refine=self.refine, seeds=seeds,
+        engine=self.engine, bounds=bounds,
+        roundPalette=self.space == colorspace.RGB)
 
-      print("%.4f%% converged." % cPerc)
+    # label every pixel of the full image in chunks
+    if sampled:
+      del data
+      print("Labeling all %d pixels..." % (width * height))
+      labels = predictLabels(inputImage, palette, metric, self.space,
+        self.engine)
 
-      numPasses += 1
+    palette = colorspace.toRGB(palette, self.space)
 
     print("Done! Execution time: %.4f seconds" % (time.time() - ts))
 
-    if not useCLib:
-      clusters = kmeans.getClusters()
-    else:
-      clusters = ckmeans.get_clusters(libkmeans, kmeans)
+    if self.regions:
+      labels = self.findRegions(inputImage, labels, width, height)
 
     # create output images
     print("Building the new image...")
-    outputImage = buildImage(clusters, K, width, height)
+    outputImage = buildImage(palette, labels, width, height)
 
-    print("Saving new image to output.png...")
-    outputImage.save("output.png")
+    print("Saving new image to %s..." % self.outputPath)
+    saveImage(outputImage, self.outputPath, self.compressLevel)
     print("Saved.")
 
     # display the results
     self.displayOutput(inputImage, outputImage, width, height)
 
-    # free memory
-    if useCLib:
-      ckmeans.free_clusters(libkmeans, kmeans)
+  # prints the connected regions of equal color. Returns the labels with
+  # regions under minRegionArea merged into their neighbors.
+  def findRegions(self, inputImage, labels, width, height):
+    print("Finding connected regions...")
+    regionMap, regions = dfs.findRegions(labels, width, height, inputImage,
+      self.minRegionArea)
+
+    print("%d regions" % len(regions))
+    for region in sorted(regions, key=lambda r: -r.area)[0:10]:
+      print("  area %d, box %s, mean color %s" % (region.area,
+        tuple(region.bbox), region.meanColor()))
+
+    # (dfs.findRegions relabeled the merged regions' pixels in place)
+    return labels
 
   def displayOutput(self, inputImage, outputImage, width, height):
     # destroy/clear existing windows
@@ -406,6 +439,11 @@ class Quantizer:
     # if we have tk and imagetk modules:
     global hasTk, hasImageTk
     if hasTk and hasImageTk:
+      # the output is at full resolution; show copies that fit on screen
+      inputImage = scaleImage(inputImage)
+      outputImage = scaleImage(outputImage.convert("RGB"))
+      width, height = inputImage.size
+
       imageWindows = []
       window = self.window
 
@@ -438,11 +476,13 @@ class Quantizer:
         if self.showInputVar.get():
           # save just in case there is a temporary file issue so the
           # user can still access the results
-          inputImage.save("input.png")
+          if self.saveInput:
+            inputImage.save("input.png")
           inputImage.show()
           outputImage.show()
       else:
-        inputImage.save("input.png")
+        if self.saveInput:
+          inputImage.save("input.png")
         inputImage.show()
         outputImage.show()
 
@@ -473,31 +513,641 @@ class ImageWindow:
   def getWindow(self):
     return self.window
 
-def buildImage(clusters, K, width, height):
-  image = Image.new("RGB", (width, height))
+"""
+  runKMeans:
+  Partitions data into K clusters with whichever implementation is loaded.
+  weights (optional) gives the number of occurrences of each data point, so
+  a color histogram can be clustered without expanding it into pixels.
+  With bisect, the clusters are built by repeatedly splitting the one with
+  the largest error in two (about N*log(K) work instead of N*K per pass)
+  and refine decides whether the usual passes then run from that result.
+  seeds (optional) replaces the first random seeds, e.g. with a previous
+  palette to warm start from; seeded runs skip bisecting and go straight
+  to the usual passes.
+  engine (optional, C only) is a ckmeans.Engine whose buffers are reused
+  instead of allocating new ones for this run.
+  seed (optional, C only) seeds the random numbers of this run (the Python
+  version draws from the shared random module).
+  bounds (optional) is the (lower, upper) corner of the box random clusters
+  are drawn from, upper exclusive; 0-256 in every component by default.
+  data can have any number of components per point (e.g. RGBA or RGB+XY),
+  not just 3.
+  stop (optional) is called after every assignment with the pass number
+  and the inertia (total error of that assignment); when it returns True
+  the run is abandoned and None is returned.
+  Returns the palette (K rounded centroids, or the unrounded ones with
+  roundPalette=False, e.g. to convert them back from another color
+  space), the cluster index of each data point and the error of each
+  cluster (the sum of distances of its points to its centroid).
+"""
+def runKMeans(data, K, T, metric=Euclidean, weights=None, bisect=False,
+  refine=True, seeds=None, engine=None, seed=None, stop=None, verbose=True,
+  bounds=None, roundPalette=True):
+  # a one-off engine, freed even if something below fails
+  if useCLib and engine is None:
+    with ckmeans.Engine(libkmeans) as engine:
+      return runKMeans(data, K, T, metric, weights, bisect, refine, seeds,
+        engine, seed, stop, verbose, bounds, roundPalette)
+
+  numPoints = len(data)
+  # components per point (3 for colors)
+  D = len(data[0]) if numPoints else 3
+  lower, upper = bounds or ((0,) * D, (256,) * D)
+
+  # initialize k-means with given parameters
+  if not useCLib:
+    kmeans = KMeans(data, K, T, metric=metric, weights=weights,
+      bounds=[(l, u - 1) for l, u in zip(lower, upper)])
+  else:
+    # convert the data once rather than every pass
+    data = engine.to_c_data(data)
+    kmeans = engine.kmeans
+    engine.init(K, T, metric, numPoints, weights, D)
+    if seed is not None:
+      ckmeans.set_seed(libkmeans, kmeans, seed)
+
+  # generate K clusters with some initial attributes
+  if verbose:
+    print("Generating initial %d clusters..." % K)
+
+  # a warm start is refined from, not bisected over
+  bisect = bisect and not seeds
 
-  for k in range(0, K):
+  if bisect:
+    if verbose:
+      print("Bisecting into %d clusters..." % K)
+
+    if not useCLib:
+      kmeans.bisectClusters()
+    else:
+      ckmeans.init_clusters(libkmeans, kmeans, lower, upper)
+      ckmeans.bisect_clusters(libkmeans, kmeans, data)
+  elif not useCLib:
+    seeds = list(seeds or [])[0:K]
+    for k in range(len(seeds), K):
+      seeds.append(kmeans.generateRandomCluster(kmeans.bounds))
+
+    kmeans.seedClusters(seeds)
+  else:
+    ckmeans.init_clusters(libkmeans, kmeans, lower, upper)
+
+    if seeds:
+      ckmeans.seed_clusters(libkmeans, kmeans, list(seeds)[0:K])
+
+  # this constant holds the maximum (Euclidean) distance between colors
+  # (or any points whose components are bytes)
+  maxDistance = K * D * 255**2
+  # has the algorithm converged? (bisecting already assigned everything)
+  converged = bisect and not refine
+  # number of passes
+  numPasses = 0
+
+  # repeat algorithm until sufficient convergence
+  while not converged:
+    if verbose:
+      print("Pass %d" % (numPasses + 1))
+    # clear pixel assignments in clusters
+    if not useCLib:
+      kmeans.clearClusters()
+    else:
+      ckmeans.clear_clusters(libkmeans, kmeans)
+
+    # assign each pixel to best cluster
+    if verbose:
+      print("1) Assigning pixels to clusters...")
+    if not useCLib:
+      kmeans.assignClusters()
+      inertia = kmeans.getInertia()
+    else:
+      ckmeans.assign_clusters(libkmeans, kmeans, data)
+      inertia = ckmeans.get_inertia(libkmeans, kmeans)
+
+    if stop is not None and stop(numPasses + 1, inertia):
+      return None
+
+    # update clusters
+    if verbose:
+      print("2) Updating clusters...")
+    if not useCLib:
+      kmeans.updateClusters()
+    else:
+      ckmeans.update_clusters(libkmeans, kmeans)
+
+    # look at threshold to determine when to terminate the algorithm.
     if not useCLib:
-      size = len(clusters[k].points)
+      cPerc = (1 - kmeans.getConvergence() / maxDistance) * 100
+      if cPerc >= kmeans.getThreshold():
+        converged = True
+    else:
+      cPerc = (1 - ckmeans.get_convergence(libkmeans, kmeans) /
+        maxDistance) * 100
+      if cPerc >= ckmeans.get_threshold(libkmeans, kmeans):
+        converged = True
+
+    if verbose:
+      print("%.4f%% converged." % cPerc)
+
+    numPasses += 1
+
+  # flatten the clusters into a palette and a label per data point
+  palette = []
+
+  if not useCLib:
+    clusters = kmeans.getClusters()
+    errors = kmeans.getClusterErrors()
+    labels = [0] * numPoints
+
+    for k in range(0, K):
+      palette.append(tuple(clusters[k].centroid))
 
       for p in clusters[k].points:
-        x = int(p % width)
-        y = int(p / width)
-        c = clusters[k].centroid
+        labels[p] = k
+  else:
+    clusters = ckmeans.get_clusters(libkmeans, kmeans)
+    errors = ckmeans.get_cluster_errors(libkmeans, kmeans)
+    labels = ckmeans.get_labels(libkmeans, kmeans, numPoints)
+
+    for k in range(0, K):
+      palette.append(tuple(clusters[k].centroid[0:D]))
+
+  if roundPalette:
+    palette = [tuple([int(round(c)) for c in color]) for color in palette]
+
+  return palette, labels, errors
+
+"""
+  RestartRace:
+  Shared between concurrent restarts to stop the ones that can't win.
+  Every finished restart records its final inertia and, for each pass,
+  the factor its inertia still shrank by from that pass to the end. A
+  running restart is given the largest such drop any finished restart
+  made from the same pass, and is only stopped if even then it would
+  finish more than margin (a fraction) above the best final inertia, and
+  if repeating its own last decrease wouldn't get it there either (a
+  restart that started badly can still be catching up fast). Nothing is
+  stopped before a restart has finished, within the first minPasses - 1
+  passes (random seeds make them noisy), or past the last pass any
+  finished restart got to.
+"""
+class RestartRace:
+  def __init__(self, margin=0.05, minPasses=2):
+    self.margin = margin
+    self.minPasses = minPasses
+    self.best = None
+    # pass number -> smallest final / inertia at that pass seen so far
+    self.drops = {}
+    self.stopped = 0
+    self.lock = threading.Lock()
+
+  # records a restart that finished with inertia, history holding its
+  # inertia after each pass (as filled in by tracker)
+  def finished(self, history, inertia):
+    with self.lock:
+      if self.best is None or inertia < self.best:
+        self.best = inertia
+
+      for numPass, passInertia in enumerate(history, 1):
+        drop = inertia / passInertia if passInertia > 0 else 1.0
+        self.drops[numPass] = min(self.drops.get(numPass, 1.0), drop)
+
+  # a stop callback for one restart's runKMeans, appending its inertia
+  # after each pass to history
+  def tracker(self, history):
+    def behind(numPass, inertia):
+      history.append(inertia)
+      if numPass < self.minPasses:
+        return False
+
+      with self.lock:
+        if self.best is None or numPass not in self.drops:
+          return False
+
+        # one more pass like the last could still take it under the bar
+        bar = self.best * (1 + self.margin)
+        if inertia * self.drops[numPass] <= bar or len(history) < 2 or \
+          history[-2] - inertia >= inertia - bar:
+          return False
+
+        self.stopped += 1
+        return True
+
+    return behind
+
+"""
+  runRestarts:
+  Runs k-means n times from different random seeds, up to workers at a
+  time in a thread pool, and returns the result with the lowest inertia
+  (the sum of the cluster errors) the same way runKMeans does. Every
+  restart reads the same converted data, and the C library runs without
+  the GIL so its restarts really run in parallel (the Python version
+  takes turns). Restarts that can't beat the best finished one are
+  stopped early (see RestartRace). engines (optional, C only) is a list
+  of ckmeans.Engine to run in; it's topped up to one per worker and the
+  caller closes them.
+"""
+def runRestarts(data, K, T, metric=Euclidean, weights=None, n=4,
+  workers=None, bisect=False, refine=True, margin=0.05, engines=None,
+  verbose=True, bounds=None, roundPalette=True):
+  workers = max(1, min(n, workers or os.cpu_count() or 1))
+  ownEngines = engines is None
+  engines = [] if engines is None else engines
+
+  if useCLib:
+    data = ckmeans.to_c_data(data)
+    while len(engines) < workers:
+      engines.append(ckmeans.Engine(libkmeans))
+
+  # engines not in use by a restart
+  idle = queue.Queue()
+  for i in range(0, workers):
+    idle.put(engines[i] if useCLib else None)
+
+  race = RestartRace(margin)
+
+  def restart(i, seed):
+    engine = idle.get()
+    history = []
+    try:
+      result = runKMeans(data, K, T, metric, weights, bisect, refine,
+        engine=engine, seed=seed, stop=race.tracker(history),
+        verbose=False, bounds=bounds, roundPalette=roundPalette)
+    finally:
+      idle.put(engine)
+
+    if result is not None:
+      race.finished(history, sum(result[2]))
+
+    return result
+
+  if verbose:
+    print("Running %d restarts on %d worker(s)..." % (n, workers))
+
+  try:
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+      results = list(pool.map(restart, range(0, n),
+        [random.getrandbits(32) for i in range(0, n)]))
+
+    for i, result in enumerate(results if verbose else []):
+      if result is None:
+        print("Restart %d stopped early" % (i + 1))
+      else:
+        print("Restart %d: inertia %.0f" % (i + 1, sum(result[2])))
+
+    # a restart is only stopped once another one has finished
+    results = [r for r in results if r is not None]
+  finally:
+    if ownEngines:
+      for engine in engines:
+        engine.close()
+
+  return min(results, key=lambda r: sum(r[2]))
+
+"""
+  sweepK:
+  Runs k-means for every K in Ks (ascending) over the same data, so the
+  image is only loaded and converted once. Each K is warm started from the
+  previous palette: the clusters with the largest error are split in two
+  by nudging their centroid either way along each channel by the
+  cluster's spread, so only those clusters have any real work to do.
+  Returns the curve as a list of (K, mean error per point, palette) and a
+  suggested K (see suggestK).
+"""
+def sweepK(data, Ks, T, metric=Euclidean, weights=None, targetError=None,
+  engine=None, bounds=None):
+  Ks = sorted(set(Ks))
+
+  # every K runs in the same buffers
+  if useCLib and engine is None:
+    with ckmeans.Engine(libkmeans) as engine:
+      return sweepK(data, Ks, T, metric, weights, targetError, engine,
+        bounds)
+
+  if useCLib:
+    data = engine.to_c_data(data)
+
+  total = float(len(data) if weights is None else sum(weights))
+
+  curve = []
+  seeds = None
+
+  for i, K in enumerate(Ks):
+    print("--- K=%d ---" % K)
+    palette, labels, errors = runKMeans(data, K, T, metric, weights,
+      seeds=seeds, engine=engine, bounds=bounds)
+    curve.append((K, sum(errors) / total, palette))
+
+    if i + 1 == len(Ks):
+      break
+
+    # weighted number of points per cluster
+    counts = [0] * K
+    if weights is None:
+      for k, n in collections.Counter(labels).items():
+        counts[k] = n
+    else:
+      for k, w in zip(labels, weights):
+        counts[k] += w
+
+    seeds = splitSeeds(palette, errors, counts, Ks[i + 1] - K, metric)
 
-        image.paste((int(c[0]), int(c[1]), int(c[2])), (x, y, x + 1, y + 1))
+  return curve, suggestK(curve, targetError)
+
+# warm start seeds for n more clusters: the palette with its n worst
+# clusters split in two. A cluster's centroid is moved down by its spread
+# in place and up by its spread as an extra seed. Any seeds still missing
+# are left to be generated randomly.
+def splitSeeds(palette, errors, counts, n, metric=Euclidean):
+  seeds = list(palette)
+  order = sorted(range(0, len(palette)), key=lambda k: -errors[k])
+
+  for k in order[0:n]:
+    if counts[k] == 0 or errors[k] <= 0:
+      continue
+
+    # typical per-channel distance of the cluster's points from its centroid
+    if metric == Manhattan:
+      spread = errors[k] / counts[k] / 3
     else:
-      size = clusters[k].size
+      spread = (errors[k] / counts[k] / 3) ** 0.5
+
+    spread = max(1, int(spread / 2))
+    c = palette[k]
+    seeds[k] = tuple([max(0, v - spread) for v in c])
+    seeds.append(tuple([min(255, v + spread) for v in c]))
+
+  return seeds
+
+"""
+  suggestK:
+  Picks a K from a curve returned by sweepK. With targetError, this is the
+  smallest K whose mean error is at most targetError (the largest K if
+  none reach it). Otherwise it's the elbow: the point farthest below the
+  straight line from the first to the last point of the normalized curve.
+"""
+def suggestK(curve, targetError=None):
+  if targetError is not None:
+    for K, error, palette in curve:
+      if error <= targetError:
+        return K
+
+    return curve[-1][0]
+
+  if len(curve) < 3:
+    return curve[-1][0]
 
-      for i in range(0, size):
-        x = int(clusters[k].indices[i] % width)
-        y = int(clusters[k].indices[i] / width)
-        c = clusters[k].centroid
+  K0, e0 = curve[0][0:2]
+  K1, e1 = curve[-1][0:2]
 
-        image.paste((int(c[0]), int(c[1]), int(c[2])), (x, y, x + 1, y + 1))
+  if e0 == e1:
+    return K0
+
+  best, bestDistance = K0, 0
+
+  for K, error, palette in curve:
+    # normalize both axes to [0, 1] (error decreasing from 1 to 0)
+    x = (K - K0) / float(K1 - K0)
+    y = (error - e1) / float(e0 - e1)
+    distance = (1 - x) - y
+
+    if distance > bestDistance:
+      best, bestDistance = K, distance
+
+  return best
+
+# scales an image down to fit maxSize x maxSize (returned as is if it
+# already fits)
+def scaleImage(image, maxSize=600):
+  width, height = image.size
+
+  if width <= maxSize and height <= maxSize:
+    return image
+
+  if width > height:
+    height = int(height * float(maxSize) / width)
+    width = maxSize
+  else:
+    width = int(width * float(maxSize) / height)
+    height = maxSize
+
+  return image.resize((width, height), Image.BILINEAR)
+
+# picks n pixels of an RGB image to fit the palette on: uniformly at random
+# ("random"), or one at a random spot in each cell of a grid over the
+# image ("grid"), which guarantees small regions get their share
+def samplePixels(image, n, mode="random"):
+  width, height = image.size
+
+  if mode == "grid":
+    step = math.sqrt(width * height / float(n))
+    cols = max(1, int(round(width / step)))
+    rows = max(1, int(round(height / step)))
+    pixels = image.load()
+
+    return [pixels[random.randrange(x * width // cols,
+        (x + 1) * width // cols),
+      random.randrange(y * height // rows, (y + 1) * height // rows)]
+      for y in range(0, rows) for x in range(0, cols)]
+
+  data = image.getdata()
+  return [data[i] for i in sorted(random.sample(range(width * height), n))]
+
+# the pixels of an RGB image in the clustering space, ready for runKMeans
+# (C data if there is an engine): all of them or, if there are more than
+# sampleSize, a sample picked by samplePixels, to be labeled with
+# predictLabels afterwards. Returns the data and whether it's a sample.
+def imageData(image, space=colorspace.RGB, engine=None,
+  sampleSize=SAMPLE_SIZE, sampleMode="random"):
+  width, height = image.size
+  sampled = bool(sampleSize) and width * height > sampleSize
+
+  if sampled and engine is not None and sampleMode == "random":
+    # the same sample, picked in C
+    image = Image.frombytes("RGB", (sampleSize, 1),
+      engine.sample_bytes(image.tobytes(), sampleSize))
+  elif sampled:
+    sample = samplePixels(image, sampleSize, sampleMode)
+    image = Image.new("RGB", (len(sample), 1))
+    image.putdata(sample)
+    del sample
+
+  image = colorspace.convertImage(image, space)
+
+  if engine is not None:
+    # straight from the pixel bytes, without holding the GIL
+    return engine.from_bytes(image.tobytes()), sampled
+  return tuple(image.getdata()), sampled
+
+# labels every pixel of an RGB image with its nearest palette color (the
+# palette being in the given color space), converting and labeling
+# chunkPixels pixels at a time so the whole image is never held as Python
+# tuples. Returns one byte per pixel (one int if there are over 256
+# colors), row by row.
+def predictLabels(image, palette, metric=Euclidean, space=colorspace.RGB,
+  engine=None, chunkPixels=1 << 20):
+  # a one-off engine, freed even if something below fails
+  if useCLib and engine is None:
+    with ckmeans.Engine(libkmeans) as engine:
+      return predictLabels(image, palette, metric, space, engine,
+        chunkPixels)
+
+  width, height = image.size
+  K, D = len(palette), len(palette[0])
+
+  if K <= 256:
+    labels = bytearray(width * height)
+  else:
+    labels = array.array("i", [0]) * (width * height)
+
+  if useCLib:
+    # only the clusters are needed, not the data buffers
+    engine.init(K, 100, metric, 1, D=D)
+    lower, upper = colorspace.getBounds(space)
+    ckmeans.init_clusters(libkmeans, engine.kmeans, lower, upper)
+    ckmeans.seed_clusters(libkmeans, engine.kmeans, palette)
+
+  rows = max(1, chunkPixels // width)
+
+  for top in range(0, height, rows):
+    band = image.crop((0, top, width, min(height, top + rows)))
+    band = colorspace.convertImage(band.convert("RGB"), space)
+    start, end = top * width, (top + band.size[1]) * width
+
+    if useCLib:
+      ckmeans.predict_bytes(libkmeans, engine.kmeans, band.tobytes(),
+        memoryview(labels)[start:end])
+    else:
+      kmeans = KMeans(tuple(band.getdata()), K, metric=metric)
+      kmeans.seedClusters(palette)
+      kmeans.assignClusters()
+
+      for k, cluster in enumerate(kmeans.getClusters()):
+        for i in cluster.points:
+          labels[start + i] = k
+
+  return labels
+
+# builds the quantized image straight from the labels: an indexed ("P")
+# image with the palette attached, or RGB if there are too many colors
+def buildImage(palette, labels, width, height):
+  if len(palette) > 256:
+    image = Image.new("RGB", (width, height))
+    image.putdata([palette[k] for k in labels])
+  else:
+    image = Image.frombytes("P", (width, height), bytes(labels))
+    image.putpalette([c for color in palette for c in color])
 
   return image
 
+# output formats and the encoder settings used for each. compressLevel is
+# zlib's 0-9 for PNG and is scaled to the 0-6 effort of lossless WebP.
+# outputPath can also be a file object if format ("png", "gif" or "webp")
+# is given.
+outputFormats = (".png", ".gif", ".webp")
+
+def saveImage(image, outputPath, compressLevel=6, format=None, **options):
+  if format:
+    ext = "." + format.lower()
+    options["format"] = format.upper()
+  else:
+    ext = os.path.splitext(outputPath)[1].lower()
+
+  if ext == ".png":
+    options["compress_level"] = compressLevel
+  elif ext == ".webp":
+    options["lossless"] = True
+    options["method"] = compressLevel * 6 // 9
+
+  image.save(outputPath, **options)
+
+"""
+  quantizeFrames:
+  Quantizes every frame of a multi-frame image (animated GIF, multi-page
+  TIFF) to one shared palette. Frames are streamed twice: once to merge
+  their color histograms, which is what gets clustered, and once to map
+  each frame to palette indices. Only one frame's pixels are held at a
+  time. With nInit > 1 the best of that many restarts is kept (see
+  runRestarts). space is the color space to cluster in (see colorspace).
+  Returns the palette and the number of frames written.
+"""
+def quantizeFrames(filename, K, T, metric=Euclidean, outputPath="output.gif",
+  bisect=False, refine=True, compressLevel=6, engine=None, nInit=1,
+  workers=None, engines=None, space=colorspace.RGB):
+  if K > 256:
+    print("Indexed output supports at most 256 colors.")
+    return None, 0
+
+  try:
+    inputImage = Image.open(filename)
+  except:
+    print("There was an error opening that file.")
+    return None, 0
+
+  # merge the color histograms of all frames
+  histogram = {}
+  numFrames = 0
+
+  for frame in ImageSequence.Iterator(inputImage):
+    frame = frame.convert("RGB")
+    width, height = frame.size
+
+    for count, color in frame.getcolors(width * height):
+      histogram[color] = histogram.get(color, 0) + count
+
+    numFrames += 1
+
+  print("Read %d frame(s) with %d distinct colors" % (numFrames,
+    len(histogram)))
+
+  colors = tuple(histogram)
+  weights = tuple([histogram[c] for c in colors])
+  del histogram
+
+  ts = time.time()
+
+  data = colorspace.convertColors(colors, space)
+  bounds = colorspace.getBounds(space)
+
+  if nInit > 1:
+    palette, labels, errors = runRestarts(data, K, T, metric, weights,
+      nInit, workers, bisect, refine, engines=engines, bounds=bounds,
+      roundPalette=space == colorspace.RGB)
+  else:
+    palette, labels, errors = runKMeans(data, K, T, metric, weights,
+      bisect, refine, engine=engine, bounds=bounds,
+      roundPalette=space == colorspace.RGB)
+
+  palette = colorspace.toRGB(palette, space)
+  del data
+
+  print("Done! Execution time: %.4f seconds" % (time.time() - ts))
+
+  # every color seen is in the lookup, so no distances are recomputed
+  lookup = dict(zip(colors, labels))
+  flatPalette = [c for color in palette for c in color]
+
+  print("Building the new frames...")
+  frames = []
+  durations = []
+
+  for frame in ImageSequence.Iterator(inputImage):
+    durations.append(frame.info.get("duration", 100))
+    frame = frame.convert("RGB")
+    width, height = frame.size
+
+    frames.append(buildImage(palette,
+      [lookup[c] for c in frame.getdata()], width, height))
+
+  print("Saving new image to %s..." % outputPath)
+  # passing the palette explicitly stops the GIF writer from giving every
+  # frame its own local copy of it
+  saveImage(frames[0], outputPath, compressLevel, save_all=True,
+    append_images=frames[1:], duration=durations,
+    loop=inputImage.info.get("loop", 0), palette=bytes(flatPalette),
+    optimize=False)
+  print("Saved.")
+
+  return palette, numFrames
+
 def validateArgs(K=1, T=0):
   valid = True
 
@@ -514,30 +1164,126 @@ def validateArgs(K=1, T=0):
 
   return valid
 
+# parses "KMIN-KMAX" or "KMIN-KMAX:STEP" into a list of K (None if invalid)
+def parseRange(text):
+  try:
+    bounds, step = (text.split(":") + ["1"])[0:2]
+    low, high = [int(k) for k in bounds.split("-")]
+    step = int(step)
+    if low < 1 or high < low or step < 1:
+      raise ValueError
+  except:
+    return None
+
+  return list(range(low, high + 1, step))
+
 def main():
   # if no args, invoke GUI
   if len(sys.argv) == 1:
     app = Quantizer(gui=True)
   else:
-    K = 8
-    T = 99.0
-    filename = sys.argv[1]
+    parser = argparse.ArgumentParser(
+      description="Color quantization using the K-means algorithm. "
+        "Run without arguments for the GUI."
+    )
+    parser.add_argument("filename")
+    parser.add_argument("K", nargs="?", default="8",
+      help="number of colors (default 8)")
+    parser.add_argument("T", nargs="?", default="99",
+      help="convergence threshold, 0-100 (default 99)")
+    parser.add_argument("--all-frames", action="store_true",
+      help="quantize every frame of an animated GIF/multi-page TIFF to "
+        "one shared palette (default output.gif)")
+    parser.add_argument("--bisect", action="store_true",
+      help="build the palette by repeatedly splitting the worst cluster "
+        "in two (faster for large K)")
+    parser.add_argument("--no-refine", action="store_true",
+      help="with --bisect, skip the regular passes afterwards")
+    parser.add_argument("--sweep", metavar="KMIN-KMAX[:STEP]",
+      help="try a range of K on the same image, print the error curve "
+        "and quantize with the suggested K (elbow of the curve)")
+    parser.add_argument("--target-error", type=float,
+      help="with --sweep, suggest the smallest K whose mean error per "
+        "pixel is at most this")
+    parser.add_argument("-o", "--output", metavar="PATH",
+      help="where to save the result: .png (default output.png), .gif or "
+        ".webp, written as an indexed image when K <= 256")
+    parser.add_argument("--compress-level", type=int, default=6,
+      choices=range(0, 10), metavar="0-9",
+      help="PNG/WebP compression effort (default 6)")
+    parser.add_argument("--no-input-save", action="store_true",
+      help="don't save a copy of the input as input.png")
+    parser.add_argument("--regions", action="store_true",
+      help="print the connected regions of equal color (area, bounding "
+        "box, mean color)")
+    parser.add_argument("--min-region-area", type=int, default=0,
+      metavar="PIXELS",
+      help="merge connected regions smaller than this into their "
+        "neighbors (implies --regions)")
+    parser.add_argument("--n-init", type=int, default=1, metavar="N",
+      help="run N differently seeded restarts in parallel and keep the "
+        "one with the lowest error (default 1)")
+    parser.add_argument("--workers", type=int, metavar="N",
+      help="with --n-init, how many restarts run at once (default: one "
+        "per CPU)")
+    parser.add_argument("--space", choices=colorspace.spaces,
+      default=colorspace.RGB,
+      help="color space to cluster in; lab and oklab give perceptually "
+        "better palettes at low K (default rgb)")
+    parser.add_argument("--sample", type=int, default=SAMPLE_SIZE,
+      metavar="PIXELS",
+      help="fit the palette on this many pixels, then label the full "
+        "image with it; 0 uses every pixel (default %d)" % SAMPLE_SIZE)
+    parser.add_argument("--sample-mode", choices=sampleModes,
+      default="random",
+      help="pick the sample uniformly at random or one pixel per cell of "
+        "a grid (default random)")
+    args = parser.parse_args()
+
+    if args.output and \
+      os.path.splitext(args.output)[1].lower() not in outputFormats:
+      print("The output file must end in one of: %s" %
+        ", ".join(outputFormats))
+      return
 
-    validArgs = True
+    sweep = None
+    if args.sweep:
+      sweep = parseRange(args.sweep)
+      if not sweep:
+        print("Please give the K range as KMIN-KMAX or KMIN-KMAX:STEP.")
+        print("Example: python quantize.py image.jpg --sweep 2-32:2")
+        return
 
-    if len(sys.argv) == 3:
-      K = sys.argv[2]
-      validArgs = validateArgs(K=K)
-    elif len(sys.argv) == 4:
-      K, T = sys.argv[2:]
-      validArgs = validateArgs(K=K, T=T)
+    if args.n_init < 1 or (args.workers is not None and args.workers < 1):
+      print("--n-init and --workers must be at least 1.")
+      return
 
-    if validArgs:
-      K = int(K)
-      T = float(T)
-      print("Using K=%d and T=%.2f" % (K, T))
+    if args.n_init > 1 and sweep:
+      print("--n-init can't be combined with --sweep (the sweep's palette "
+        "seeds the final run).")
+      return
+
+    if args.sample < 0:
+      print("--sample must be at least 0.")
+      return
 
-      app = Quantizer(gui=False, K=K, T=T, filename=filename)
+    if validateArgs(K=args.K, T=args.T):
+      K = int(args.K)
+      T = float(args.T)
+      if sweep:
+        print("Trying K=%d..%d with T=%.2f" % (sweep[0], sweep[-1], T))
+      else:
+        print("Using K=%d and T=%.2f" % (K, T))
+
+      app = Quantizer(gui=False, K=K, T=T, filename=args.filename,
+        allFrames=args.all_frames, bisect=args.bisect,
+        refine=not args.no_refine, sweep=sweep,
+        targetError=args.target_error, outputPath=args.output,
+        compressLevel=args.compress_level,
+        saveInput=not args.no_input_save, regions=args.regions,
+        minRegionArea=args.min_region_area, nInit=args.n_init,
+        workers=args.workers, space=args.space,
+        sampleSize=args.sample or None, sampleMode=args.sample_mode)
       app.quantize()
 
 if __name__ == "__main__":
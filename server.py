@@ -0,0 +1,523 @@
+"""
+  Local quantization server
+
+  Keeps the quantizer running so callers don't pay for starting Python,
+  importing PIL and loading the C library on every image. Images are
+  POSTed over HTTP, either on a TCP port or a Unix socket, and a pool of
+  worker threads quantizes them. Each worker keeps a warm engine (C buffers
+  sized to the largest image it has seen).
+
+  Concurrent requests are spread over the workers, each taking the next
+  queued job as soon as it's free, so a small image never waits behind a
+  large one while another worker is idle. Small images waiting in the
+  queue for a color space other than RGB are batched: the worker that
+  takes one converts it together with the others in one pass (converting
+  has a fixed cost that dominates for thumbnails) and puts the rest back
+  at the front of the queue for whichever worker is free next.
+
+  Endpoints:
+  * POST /quantize?K=8&T=99&metric=euclidean&space=rgb&format=png&bisect=0
+    &n_init=1&sample=360000&resize=0  with the image file as the body.
+    The response body is the indexed image, and the X-Quantize-Stats
+    header holds a JSON object of stats (size, palette, inertia,
+    queue/run/total seconds). The palette is fit on a sample of the
+    pixels (sample=0 for all of them) and every pixel is then labeled.
+  * GET /metrics  queue depth, counters and latency quantiles in the
+    Prometheus text format.
+  * GET /health
+
+  Usage:
+  python server.py [--port 8080 | --socket /tmp/quantize.sock] [--workers N]
+    [--batch-pixels N]
+
+  Example:
+  curl --data-binary @image.jpg -o out.png \
+    "http://127.0.0.1:8080/quantize?K=16"
+"""
+
+import os
+import io
+import json
+import time
+import queue
+import argparse
+import threading
+import collections
+import socketserver
+import http.server
+import urllib.parse
+
+import quantize
+import colorspace
+from quantize import Image, Euclidean, Manhattan
+
+metricNames = {"euclidean": Euclidean, "manhattan": Manhattan}
+formats = {"png": "image/png", "gif": "image/gif", "webp": "image/webp"}
+
+# the body is streamed back in pieces of this size
+CHUNK_SIZE = 64 * 1024
+# images of at most this many pixels are batched (see WorkerPool)
+BATCH_PIXELS = 256 * 256
+
+"""
+  Job:
+  One quantization request: its parameters, the image file and, once a
+  worker is done with it, the output file and stats (or the error).
+"""
+class Job:
+  def __init__(self, body, K=8, T=99, metric=Euclidean, format="png",
+         bisect=False, nInit=1, resize=False, space=colorspace.RGB,
+         sample=quantize.SAMPLE_SIZE):
+    self.body = body
+    self.K = K
+    self.T = T
+    self.metric = metric
+    self.format = format
+    self.bisect = bisect
+    self.nInit = nInit
+    # scale the image down first, as before sampling (off by default)
+    self.resize = resize
+    self.space = space
+    # fit on this many pixels (None = all), then label them all
+    self.sample = sample
+    # make sure it's an image without decoding the pixels yet
+    self.size = Image.open(io.BytesIO(body)).size
+    # the decoded image, and the same converted into space, if a batch
+    # already did that (see WorkerPool)
+    self.image = self.converted = None
+    self.received = time.time()
+    self.started = self.finished = None
+    self.output = self.stats = self.error = None
+    self.done = threading.Event()
+
+  # parses the query string of a request into a Job (ValueError if a
+  # parameter is invalid)
+  @staticmethod
+  def fromQuery(body, query):
+    params = dict(urllib.parse.parse_qsl(query))
+    unknown = set(params) - set(["K", "T", "metric", "space", "format",
+      "bisect", "n_init", "resize", "sample"])
+    if unknown:
+      raise ValueError("unknown parameter(s): %s" %
+        ", ".join(sorted(unknown)))
+
+    K = int(params.get("K", 8))
+    T = float(params.get("T", 99))
+    nInit = int(params.get("n_init", 1))
+    sample = int(params.get("sample", quantize.SAMPLE_SIZE))
+    if K < 1 or T < 0 or T > 100 or nInit < 1 or sample < 0:
+      raise ValueError("K and n_init must be at least 1, T within 0-100 "
+        "and sample at least 0")
+
+    metric = params.get("metric", "euclidean").lower()
+    format = params.get("format", "png").lower()
+    space = params.get("space", colorspace.RGB).lower()
+    if metric not in metricNames or format not in formats or \
+      space not in colorspace.spaces:
+      raise ValueError("metric must be one of %s, space one of %s, format "
+        "one of %s" % (", ".join(metricNames), ", ".join(colorspace.spaces),
+        ", ".join(formats)))
+
+    try:
+      return Job(body, K, T, metricNames[metric], format,
+        params.get("bisect", "0") == "1", nInit,
+        params.get("resize", "0") == "1", space, sample or None)
+    except IOError:
+      raise ValueError("the body is not an image PIL can read")
+
+  # quantizes the image into self.output and self.stats. stop (optional)
+  # is passed on to runKMeans (it isn't called with n_init > 1); returns
+  # False if it stopped the run.
+  def run(self, engine, stop=None):
+    self.started = time.time()
+
+    inputImage = self.decode()
+    self.image = None
+    width, height = inputImage.size
+
+    if self.converted is not None:
+      data, sampled = quantize.imageData(self.converted, colorspace.RGB,
+        engine, None)
+      self.converted = None
+    else:
+      data, sampled = quantize.imageData(inputImage, self.space, engine,
+        self.sample)
+    bounds = colorspace.getBounds(self.space)
+
+    if self.nInit > 1:
+      palette, labels, errors = quantize.runRestarts(data, self.K, self.T,
+        self.metric, n=self.nInit, workers=1, bisect=self.bisect,
+        engines=[engine] if engine is not None else None, verbose=False,
+        bounds=bounds, roundPalette=self.space == colorspace.RGB)
+    else:
+      result = quantize.runKMeans(data, self.K, self.T, self.metric,
+        bisect=self.bisect, engine=engine, stop=stop, verbose=False,
+        bounds=bounds, roundPalette=self.space == colorspace.RGB)
+      if result is None:
+        return False
+      palette, labels, errors = result
+
+    # label every pixel of the image with the palette fit on the sample
+    if sampled:
+      del data
+      labels = quantize.predictLabels(inputImage, palette, self.metric,
+        self.space, engine)
+
+    palette = colorspace.toRGB(palette, self.space)
+
+    output = io.BytesIO()
+    quantize.saveImage(quantize.buildImage(palette, labels, width, height),
+      output, format=self.format)
+    self.output = output.getvalue()
+
+    self.finished = time.time()
+    self.stats = {
+      "width": width,
+      "height": height,
+      "K": self.K,
+      "palette": palette,
+      "inertia": sum(errors),
+      "queueSeconds": round(self.started - self.received, 6),
+      "runSeconds": round(self.finished - self.started, 6)
+    }
+    return True
+
+  # the RGB image to quantize (decoded once)
+  def decode(self):
+    if self.image is None:
+      image = Image.open(io.BytesIO(self.body)).convert("RGB")
+      if self.resize:
+        image = quantize.scaleImage(image)
+      self.image = image
+
+    return self.image
+
+  # whether the job can share a conversion pass: small, fit on all of its
+  # pixels and in a space that needs converting
+  def batchable(self, maxPixels):
+    pixels = self.size[0] * self.size[1]
+    return pixels <= maxPixels and self.space != colorspace.RGB and \
+      not self.resize and not (self.sample and pixels > self.sample)
+
+"""
+  Metrics:
+  Counters and recent latencies, shared by the request handlers and the
+  workers. Quantiles are taken over the last window samples.
+"""
+class Metrics:
+  def __init__(self, window=1024):
+    self.lock = threading.Lock()
+    self.counters = collections.Counter()
+    self.latencies = collections.defaultdict(
+      lambda: collections.deque(maxlen=window))
+    self.sums = collections.Counter()
+    self.counts = collections.Counter()
+
+  def count(self, name, n=1):
+    with self.lock:
+      self.counters[name] += n
+
+  def observe(self, name, seconds):
+    with self.lock:
+      self.latencies[name].append(seconds)
+      self.sums[name] += seconds
+      self.counts[name] += 1
+
+  # text exposition format, with the gauges passed in
+  def render(self, gauges):
+    lines = []
+
+    with self.lock:
+      for name, value in sorted(gauges.items()):
+        lines.append("# TYPE quantize_%s gauge" % name)
+        lines.append("quantize_%s %d" % (name, value))
+
+      for name, value in sorted(self.counters.items()):
+        lines.append("# TYPE quantize_%s_total counter" % name)
+        lines.append("quantize_%s_total %d" % (name, value))
+
+      for name, samples in sorted(self.latencies.items()):
+        samples = sorted(samples)
+        lines.append("# TYPE quantize_%s_seconds summary" % name)
+        for q in (0.5, 0.9, 0.99):
+          lines.append('quantize_%s_seconds{quantile="%g"} %.6f' %
+            (name, q, samples[min(len(samples) - 1, int(q * len(samples)))]))
+        lines.append("quantize_%s_seconds_sum %.6f" % (name, self.sums[name]))
+        lines.append("quantize_%s_seconds_count %d" %
+          (name, self.counts[name]))
+
+    return "\n".join(lines) + "\n"
+
+"""
+  WorkerPool:
+  Worker threads that each own an engine and take jobs off one queue, one
+  at a time. The queue holds at most maxQueue jobs; submit raises
+  queue.Full beyond that. A worker taking a batchable job (at most
+  batchPixels pixels, 0 to never batch) also takes up to maxBatch - 1
+  queued jobs like it, converts them all in one pass and puts the others
+  back at the front of the queue, converted. Jobs that aren't batchable
+  are never taken out of turn.
+"""
+class WorkerPool:
+  def __init__(self, workers=None, maxQueue=64, metrics=None,
+    batchPixels=BATCH_PIXELS, maxBatch=16):
+    self.jobs = queue.Queue(maxQueue)
+    self.metrics = metrics or Metrics()
+    self.batchPixels = batchPixels
+    self.maxBatch = maxBatch
+    self.busy = 0
+    self.lock = threading.Lock()
+    self.threads = []
+
+    for i in range(0, workers or os.cpu_count() or 1):
+      thread = threading.Thread(target=self.work, name="worker-%d" % i)
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+  def submit(self, job):
+    self.jobs.put_nowait(job)
+
+  def depth(self):
+    return self.jobs.qsize()
+
+  def work(self):
+    if quantize.useCLib:
+      engine = quantize.ckmeans.Engine(quantize.libkmeans)
+    else:
+      engine = None
+
+    while True:
+      job = self.jobs.get()
+      if job is None:
+        break
+
+      with self.lock:
+        self.busy += 1
+
+      if job.converted is None and job.batchable(self.batchPixels):
+        self.convertBatch(job)
+
+      try:
+        job.run(engine)
+        self.metrics.observe("queue", job.started - job.received)
+        self.metrics.observe("run", job.finished - job.started)
+      except Exception as e:
+        job.error = e
+        self.metrics.count("failed")
+      job.done.set()
+
+      with self.lock:
+        self.busy -= 1
+
+    if engine is not None:
+      engine.close()
+
+  # converts job and the queued jobs it can share a pass with, then hands
+  # those back to the queue (first in line, in their order)
+  def convertBatch(self, job):
+    batch = []
+
+    with self.jobs.mutex:
+      for other in list(self.jobs.queue):
+        if len(batch) + 1 >= self.maxBatch:
+          break
+        if other is not None and other.converted is None and \
+          other.space == job.space and other.batchable(self.batchPixels):
+          self.jobs.queue.remove(other)
+          batch.append(other)
+
+    # an image that fails to decode is left for its own run to report
+    jobs = [job]
+    for other in batch:
+      try:
+        other.decode()
+        jobs.append(other)
+      except Exception:
+        pass
+
+    if len(jobs) > 1:
+      try:
+        images = colorspace.convertImages([j.decode() for j in jobs],
+          job.space)
+      except Exception:
+        images = [None] * len(jobs)
+
+      for j, image in zip(jobs, images):
+        j.converted = image
+      self.metrics.count("batched", len(jobs))
+
+    with self.jobs.mutex:
+      self.jobs.queue.extendleft(reversed(batch))
+      self.jobs.not_empty.notify(len(batch))
+
+  def close(self):
+    for thread in self.threads:
+      self.jobs.put(None)
+
+    for thread in self.threads:
+      thread.join()
+
+"""
+  RequestHandler:
+  Routes the endpoints to the server's worker pool.
+"""
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  # Unix socket clients have no address
+  def address_string(self):
+    if isinstance(self.client_address, tuple):
+      return self.client_address[0]
+    return "unix"
+
+  # close (for replies sent before the request body was read) hangs up
+  # afterwards, so the unread body isn't taken for the next request
+  def sendText(self, status, text, contentType="text/plain", close=False):
+    body = text.encode("utf-8")
+    self.send_response(status)
+    self.send_header("Content-Type", contentType + "; charset=utf-8")
+    self.send_header("Content-Length", str(len(body)))
+    if close:
+      self.send_header("Connection", "close")
+      self.close_connection = True
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    path = urllib.parse.urlsplit(self.path).path
+    pool = self.server.pool
+
+    if path == "/metrics":
+      self.sendText(200, pool.metrics.render({
+        "queue_depth": pool.depth(),
+        "busy_workers": pool.busy,
+        "workers": len(pool.threads)
+      }), "text/plain; version=0.0.4")
+    elif path == "/health":
+      self.sendText(200, "ok\n")
+    else:
+      self.sendText(404, "not found\n")
+
+  def do_POST(self):
+    url = urllib.parse.urlsplit(self.path)
+    pool = self.server.pool
+
+    if url.path != "/quantize":
+      self.sendText(404, "not found\n", close=True)
+      return
+
+    pool.metrics.count("requests")
+
+    # a chunked body has no Content-Length and is refused like a missing one
+    try:
+      length = int(self.headers.get("Content-Length") or 0)
+    except ValueError:
+      length = 0
+    if length <= 0 or length > self.server.maxBytes:
+      pool.metrics.count("rejected")
+      self.sendText(413 if length > 0 else 411,
+        "send the image as the body (at most %d bytes)\n" %
+        self.server.maxBytes, close=True)
+      return
+
+    body = self.rfile.read(length)
+
+    try:
+      job = Job.fromQuery(body, url.query)
+    except ValueError as e:
+      pool.metrics.count("rejected")
+      self.sendText(400, "%s\n" % e)
+      return
+
+    try:
+      pool.submit(job)
+    except queue.Full:
+      pool.metrics.count("rejected")
+      self.send_response(503)
+      self.send_header("Retry-After", "1")
+      self.send_header("Content-Length", "0")
+      self.end_headers()
+      return
+
+    job.done.wait()
+
+    if job.error is not None:
+      self.sendText(500, "quantization failed: %s\n" % job.error)
+      return
+
+    job.stats["totalSeconds"] = round(time.time() - job.received, 6)
+    pool.metrics.observe("latency", job.stats["totalSeconds"])
+
+    self.send_response(200)
+    self.send_header("Content-Type", formats[job.format])
+    self.send_header("Content-Length", str(len(job.output)))
+    self.send_header("X-Quantize-Stats", json.dumps(job.stats,
+      separators=(",", ":")))
+    self.end_headers()
+
+    for i in range(0, len(job.output), CHUNK_SIZE):
+      self.wfile.write(job.output[i:i + CHUNK_SIZE])
+
+class TCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+  daemon_threads = True
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+# creates the server (TCP unless socketPath is given) with pool attached
+def createServer(pool, host="127.0.0.1", port=8080, socketPath=None,
+  maxBytes=32 * 1024 * 1024):
+  if socketPath:
+    # remove a socket left behind by a previous run
+    if os.path.exists(socketPath):
+      os.unlink(socketPath)
+    server = UnixServer(socketPath, RequestHandler)
+  else:
+    server = TCPServer((host, port), RequestHandler)
+
+  server.pool = pool
+  server.maxBytes = maxBytes
+  return server
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Serve color quantization over HTTP."
+  )
+  parser.add_argument("--host", default="127.0.0.1",
+    help="address to listen on (default 127.0.0.1)")
+  parser.add_argument("--port", type=int, default=8080,
+    help="TCP port (default 8080)")
+  parser.add_argument("--socket", metavar="PATH",
+    help="listen on this Unix socket instead of a TCP port")
+  parser.add_argument("--workers", type=int,
+    help="worker threads, each with its own engine (default: one per CPU)")
+  parser.add_argument("--max-queue", type=int, default=64,
+    help="queued requests before answering 503 (default 64)")
+  parser.add_argument("--max-bytes", type=int, default=32 * 1024 * 1024,
+    help="largest accepted request body (default 32 MiB)")
+  parser.add_argument("--batch-pixels", type=int, default=BATCH_PIXELS,
+    help="batch the conversion of queued images up to this many pixels "
+      "(default %d, 0 to never batch)" % BATCH_PIXELS)
+  args = parser.parse_args()
+
+  pool = WorkerPool(args.workers, args.max_queue,
+    batchPixels=args.batch_pixels)
+  server = createServer(pool, args.host, args.port, args.socket,
+    args.max_bytes)
+
+  print("Listening on %s with %d worker(s)" % (args.socket or
+    "http://%s:%d" % (args.host, args.port), len(pool.threads)))
+
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    pool.close()
+    if args.socket and os.path.exists(args.socket):
+      os.unlink(args.socket)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,206 @@
+"""
+  C engine on inputs past the old 32-bit limits, and its distance kernels
+  for any number of components
+
+  Cluster sizes, point indices and centroid sums used to be C ints, so an
+  image of more than 2^31 / 255 pixels (or a histogram whose weights add
+  up to more than 2^31) overflowed them. Labels, errors and centroids of
+  flat and bisecting passes are recomputed in Python for the unrolled
+  kernels (3 to 5 components) and the generic ones. Build the library
+  first (see the header of kmeans.c); the tests are skipped if it can't be
+  loaded.
+"""
+
+import random
+from array import array
+
+import pytest
+
+import ckmeans
+
+libkmeans = ckmeans.load() if ckmeans.hasCTypes() else None
+
+pytestmark = pytest.mark.skipif(not libkmeans,
+  reason="the C library isn't built")
+
+# one assignment and update of K clusters seeded with seeds
+def runPass(engine, data, seeds, weights=None):
+  D = len(seeds[0])
+  engine.init(len(seeds), 100, ckmeans.Euclidean, len(data), weights, D)
+  ckmeans.init_clusters(libkmeans, engine.kmeans, (0,) * D, (256,) * D)
+  ckmeans.seed_clusters(libkmeans, engine.kmeans, seeds)
+  ckmeans.clear_clusters(libkmeans, engine.kmeans)
+  ckmeans.assign_clusters(libkmeans, engine.kmeans, data)
+  inertia = ckmeans.get_inertia(libkmeans, engine.kmeans)
+  ckmeans.update_clusters(libkmeans, engine.kmeans)
+
+  clusters = ckmeans.get_clusters(libkmeans, engine.kmeans)
+  sizes = [clusters[k].size for k in range(len(seeds))]
+  centroids = [tuple(clusters[k].centroid[0:D])
+    for k in range(len(seeds))]
+  return sizes, centroids, inertia
+
+def testManyPixels():
+  # 2^31 / 255 is about 8.4M: white pixels past that overflowed the sums
+  white, black = 9000000, 1000000
+
+  with ckmeans.Engine(libkmeans) as engine:
+    data = engine.from_bytes(b"\x00" * black + b"\xff" * white, D=1)
+    assert len(data) == white + black
+
+    sizes, centroids, inertia = runPass(engine, data, [(0,), (255,)])
+    assert sizes == [black, white]
+    assert centroids == [(0.0,), (255.0,)]
+    assert inertia == 0
+
+    sizes, centroids, inertia = runPass(engine, data, [(0,)])
+    assert sizes == [white + black]
+    assert centroids[0][0] == pytest.approx(255.0 * white / (white + black))
+    assert inertia == white * 255.0 ** 2
+
+def testHeavyWeights():
+  # a histogram whose counts don't fit in 32 bits (sizes count colors)
+  data = [(0, 0, 0), (10, 20, 30), (255, 255, 255)]
+  weights = [1 << 33, 3 << 32, 1 << 33]
+
+  with ckmeans.Engine(libkmeans) as engine:
+    sizes, centroids, inertia = runPass(engine, data,
+      [(0, 0, 0), (255, 255, 255)], weights)
+
+  assert sizes == [2, 1]
+  assert centroids == [(6.0, 12.0, 18.0), (255.0, 255.0, 255.0)]
+  assert inertia == (10 ** 2 + 20 ** 2 + 30 ** 2) * float(3 << 32)
+
+# the distances the C engine minimizes (Euclidean is squared)
+def distance(metric, a, b):
+  if metric == ckmeans.Manhattan:
+    return sum([abs(x - y) for x, y in zip(a, b)])
+  return sum([(x - y) ** 2 for x, y in zip(a, b)])
+
+# n random points of D byte-valued components
+def randomPoints(rng, n, D):
+  return [tuple([rng.randrange(256) for c in range(0, D)])
+    for i in range(0, n)]
+
+# per-cluster sums of the (weighted) distances to the centroids
+def clusterErrors(metric, data, weights, labels, centroids):
+  errors = [0.0] * len(centroids)
+  for point, w, k in zip(data, weights, labels):
+    errors[k] += distance(metric, centroids[k], point) * w
+  return errors
+
+# (weighted) means of the points of each cluster
+def clusterMeans(data, weights, labels, K):
+  D = len(data[0])
+  sums = [[0.0] * (D + 1) for k in range(0, K)]
+  for point, w, k in zip(data, weights, labels):
+    for c in range(0, D):
+      sums[k][c] += point[c] * w
+    sums[k][D] += w
+  return [tuple([s / total[D] for s in total[0:D]]) for total in sums]
+
+def getCentroids(engine, K, D):
+  clusters = ckmeans.get_clusters(libkmeans, engine.kmeans)
+  return [tuple(clusters[k].centroid[0:D]) for k in range(0, K)]
+
+DIMENSIONS = [2, 3, 4, 5, 7]
+METRICS = [ckmeans.Euclidean, ckmeans.Manhattan]
+
+@pytest.mark.parametrize("D", DIMENSIONS)
+@pytest.mark.parametrize("metric", METRICS)
+@pytest.mark.parametrize("weighted", [False, True])
+def testFlatPass(D, metric, weighted):
+  rng = random.Random(D * 10 + metric)
+  data = randomPoints(rng, 600, D)
+  weights = [rng.randrange(1, 6) if weighted else 1 for point in data]
+  # fractional seeds, so no point is equally far from two of them
+  seeds = [tuple([x + 0.25 * k for x in data[k]]) for k in range(0, 9)]
+  K = len(seeds)
+
+  with ckmeans.Engine(libkmeans) as engine:
+    engine.init(K, 99, metric, len(data), weights if weighted else None, D)
+    ckmeans.init_clusters(libkmeans, engine.kmeans, (0,) * D, (256,) * D)
+    ckmeans.seed_clusters(libkmeans, engine.kmeans, seeds)
+    ckmeans.clear_clusters(libkmeans, engine.kmeans)
+    cdata = engine.to_c_data(data)
+    ckmeans.assign_clusters(libkmeans, engine.kmeans, cdata)
+
+    labels = ckmeans.get_labels(libkmeans, engine.kmeans, len(data))
+    inertia = ckmeans.get_inertia(libkmeans, engine.kmeans)
+    errors = ckmeans.get_cluster_errors(libkmeans, engine.kmeans)
+
+    # every point went to its nearest seed
+    for point, k in zip(data, labels):
+      nearest = min([distance(metric, seed, point) for seed in seeds])
+      assert distance(metric, seeds[k], point) == \
+        pytest.approx(nearest, rel=1e-5)
+
+    expected = clusterErrors(metric, data, weights, labels, seeds)
+    assert errors == pytest.approx(expected, rel=1e-5)
+    assert inertia == pytest.approx(sum(expected), rel=1e-5)
+
+    ckmeans.update_clusters(libkmeans, engine.kmeans)
+    centroids = getCentroids(engine, K, D)
+    assert [c for centroid in centroids for c in centroid] == pytest.approx(
+      [c for mean in clusterMeans(data, weights, labels, K) for c in mean],
+      rel=1e-5)
+
+    clusters = ckmeans.get_clusters(libkmeans, engine.kmeans)
+    assert [clusters[k].size for k in range(0, K)] == \
+      [labels.count(k) for k in range(0, K)]
+
+@pytest.mark.parametrize("D", DIMENSIONS)
+@pytest.mark.parametrize("metric", METRICS)
+@pytest.mark.parametrize("weighted", [False, True])
+def testBisect(D, metric, weighted):
+  rng = random.Random(D * 10 + metric + 1)
+  data = randomPoints(rng, 600, D)
+  weights = [rng.randrange(1, 6) if weighted else 1 for point in data]
+  K = 8
+
+  with ckmeans.Engine(libkmeans) as engine:
+    engine.init(K, 99, metric, len(data), weights if weighted else None, D)
+    ckmeans.init_clusters(libkmeans, engine.kmeans, (0,) * D, (256,) * D)
+    ckmeans.set_seed(libkmeans, engine.kmeans, 1)
+    ckmeans.bisect_clusters(libkmeans, engine.kmeans, engine.to_c_data(data))
+
+    labels = ckmeans.get_labels(libkmeans, engine.kmeans, len(data))
+    centroids = getCentroids(engine, K, D)
+    clusters = ckmeans.get_clusters(libkmeans, engine.kmeans)
+
+    # all of the clusters were filled, each with the points labeled with it
+    sizes = [labels.count(k) for k in range(0, K)]
+    assert min(sizes) > 0
+    assert [clusters[k].size for k in range(0, K)] == sizes
+
+    assert [c for centroid in centroids for c in centroid] == pytest.approx(
+      [c for mean in clusterMeans(data, weights, labels, K) for c in mean],
+      rel=1e-5)
+    assert ckmeans.get_cluster_errors(libkmeans, engine.kmeans) == \
+      pytest.approx(clusterErrors(metric, data, weights, labels, centroids),
+        rel=1e-5)
+
+@pytest.mark.parametrize("D", DIMENSIONS)
+@pytest.mark.parametrize("metric", METRICS)
+@pytest.mark.parametrize("K", [9, 300])
+def testPredictBytesMatchesAssign(D, metric, K):
+  rng = random.Random(D * 10 + metric + K)
+  pixels = bytes([rng.randrange(256) for i in range(0, 700 * D)])
+  seeds = [tuple([rng.random() * 255 for c in range(0, D)])
+    for k in range(0, K)]
+
+  with ckmeans.Engine(libkmeans) as engine:
+    data = engine.from_bytes(pixels, D)
+    engine.init(K, 99, metric, len(data), None, D)
+    ckmeans.init_clusters(libkmeans, engine.kmeans, (0,) * D, (256,) * D)
+    ckmeans.seed_clusters(libkmeans, engine.kmeans, seeds)
+    ckmeans.clear_clusters(libkmeans, engine.kmeans)
+    ckmeans.assign_clusters(libkmeans, engine.kmeans, data)
+    labels = ckmeans.get_labels(libkmeans, engine.kmeans, len(data))
+
+    # one byte per label up to 256 clusters, otherwise one int
+    predicted = bytearray(len(data)) if K <= 256 else \
+      array("i", [0]) * len(data)
+    ckmeans.predict_bytes(libkmeans, engine.kmeans, pixels, predicted)
+
+  assert list(predicted) == labels
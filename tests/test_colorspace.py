@@ -0,0 +1,63 @@
+"""
+  Lookup table accuracy and palette round trips through the color spaces
+"""
+
+import random
+
+import pytest
+
+import colorspace
+import quantize
+
+# the whole dark corner (where OKLab's cube root is steepest) plus a
+# spread of other colors
+def sampleColors():
+  rng = random.Random(0)
+  colors = [(r, g, b) for r in range(0, 40) for g in range(0, 40)
+    for b in range(0, 40)]
+  colors += [(rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    for i in range(0, 20000)]
+  return colors
+
+@pytest.mark.parametrize("space", [colorspace.Lab, colorspace.OKLab])
+def testLUTMatchesEncode(space):
+  colors = sampleColors()
+  converted = colorspace.convertColors(colors, space)
+
+  worst = 0
+  for color, stored in zip(colors, converted):
+    exact = colorspace.encode(space, *[c / 255.0 for c in color])
+    worst = max(worst, max([abs(a - b) for a, b in zip(exact, stored)]))
+
+  # rounding to bytes alone is up to 0.5
+  assert worst < 1.25
+
+@pytest.mark.parametrize("space", [colorspace.Lab, colorspace.OKLab])
+def testPaletteIsDecodedUnrounded(space):
+  data = colorspace.convertColors([(0, 255, 0), (9, 240, 5), (3, 250, 30)]
+    * 10, space)
+  mean = [sum([color[c] for color in data]) / float(len(data))
+    for c in range(0, 3)]
+
+  palette, labels, errors = quantize.runKMeans(data, 1, 99,
+    seeds=data[0:1], verbose=False, bounds=colorspace.getBounds(space),
+    roundPalette=False)
+
+  assert palette[0] == pytest.approx(mean, abs=1e-4)
+  assert colorspace.toRGB(palette, space) == [colorspace.decode(space,
+    palette[0])]
+
+@pytest.mark.parametrize("space", [colorspace.Lab, colorspace.OKLab])
+def testPrimariesRoundTrip(space):
+  primaries = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (0, 0, 0),
+    (255, 255, 255), (128, 128, 128)]
+  data = colorspace.convertColors(primaries * 50, space)
+
+  palette, labels, errors = quantize.runKMeans(data, len(primaries), 99,
+    seeds=data[0:len(primaries)], verbose=False,
+    bounds=colorspace.getBounds(space), roundPalette=False)
+
+  # the pixels themselves are stored as bytes, and half a byte near the
+  # corners of the gamut is worth up to 14 in RGB (e.g. OKLab's green)
+  for color, primary in zip(colorspace.toRGB(palette, space), primaries):
+    assert max([abs(a - b) for a, b in zip(color, primary)]) <= 16
@@ -0,0 +1,192 @@
+"""
+  Connected regions of label maps against a brute-force flood fill, and
+  multi-scale segmentation of a simple image
+"""
+
+import random
+from array import array
+
+import pytest
+
+from PIL import Image
+
+import dfs
+
+NEIGHBORS = {
+  4: [(-1, 0), (1, 0), (0, -1), (0, 1)],
+  8: [(dx, dy) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dx or dy]
+}
+
+# region index of every pixel, seeded in row-major order (which is also
+# how findRegions numbers its regions)
+def floodFill(labels, width, height, connectivity):
+  component = [-1] * (width * height)
+  count = 0
+
+  for seed in range(0, width * height):
+    if component[seed] != -1:
+      continue
+
+    component[seed] = count
+    stack = [seed]
+    while stack:
+      y, x = divmod(stack.pop(), width)
+      for dx, dy in NEIGHBORS[connectivity]:
+        nx, ny = x + dx, y + dy
+        p = ny * width + nx
+        if 0 <= nx < width and 0 <= ny < height and component[p] == -1 \
+          and labels[p] == labels[seed]:
+          component[p] = count
+          stack.append(p)
+    count += 1
+
+  return component, count
+
+# area, bbox and mean color of every region of a region map
+def regionStats(regionMap, count, width, pixels):
+  areas = [0] * count
+  boxes = [None] * count
+  sums = [[0, 0, 0] for i in range(0, count)]
+
+  for p, region in enumerate(regionMap):
+    y, x = divmod(p, width)
+    areas[region] += 1
+    box = boxes[region]
+    if box is None:
+      boxes[region] = [x, y, x + 1, y + 1]
+    else:
+      boxes[region] = [min(box[0], x), min(box[1], y), max(box[2], x + 1),
+        max(box[3], y + 1)]
+    for c in range(0, 3):
+      sums[region][c] += pixels[p][c]
+
+  means = [tuple([int(round(s / float(area))) for s in colorSum])
+    for colorSum, area in zip(sums, areas)]
+  return areas, boxes, means
+
+# random label maps with blobs: runs along rows and repeated rows
+def randomLabels(rng, width, height, numLabels):
+  labels = []
+  for y in range(0, height):
+    if y and rng.random() < 0.5:
+      row = labels[-width:]
+      for i in range(0, rng.randrange(0, 3)):
+        row[rng.randrange(width)] = rng.randrange(numLabels)
+    else:
+      row = []
+      while len(row) < width:
+        row += [rng.randrange(numLabels)] * rng.randrange(1, 5)
+      row = row[0:width]
+    labels += row
+  return labels
+
+def randomImage(rng, width, height):
+  pixels = [(rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    for i in range(0, width * height)]
+  image = Image.new("RGB", (width, height))
+  image.putdata(pixels)
+  return image, pixels
+
+SIZES = [(23, 17), (1, 9), (9, 1), (6, 6)]
+
+@pytest.mark.parametrize("connectivity", [4, 8])
+@pytest.mark.parametrize("width,height", SIZES)
+def testRegionsMatchFloodFill(connectivity, width, height):
+  rng = random.Random(width * height + connectivity)
+
+  for trial in range(0, 10):
+    labels = randomLabels(rng, width, height, 1 + trial % 4)
+    image, pixels = randomImage(rng, width, height)
+
+    regionMap, regions = dfs.findRegions(array("B", labels), width, height,
+      image, connectivity=connectivity)
+    component, count = floodFill(labels, width, height, connectivity)
+
+    assert list(regionMap) == component
+    assert len(regions) == count
+
+    areas, boxes, means = regionStats(component, count, width, pixels)
+    for i, region in enumerate(regions):
+      assert region.label == labels[component.index(i)]
+      assert region.area == areas[i]
+      assert region.bbox == boxes[i]
+      assert region.meanColor() == means[i]
+
+# the kinds of label sequences findRegions relabels in place
+CONTAINERS = [bytearray, lambda l: array("B", l),
+  lambda l: array("i", l), lambda l: array("l", l), list]
+
+@pytest.mark.parametrize("connectivity", [4, 8])
+@pytest.mark.parametrize("minArea", [2, 5, 12])
+def testSmallRegionsAreMerged(connectivity, minArea):
+  rng = random.Random(minArea * connectivity)
+  width, height = 19, 13
+
+  for trial in range(0, 10):
+    original = randomLabels(rng, width, height, 2 + trial % 3)
+    image, pixels = randomImage(rng, width, height)
+    component, count = floodFill(original, width, height, connectivity)
+
+    results = []
+    for container in CONTAINERS:
+      labels = container(original)
+      regionMap, regions = dfs.findRegions(labels, width, height, image,
+        minArea, connectivity)
+      results.append((list(regionMap), [(r.label, r.area, r.bbox)
+        for r in regions]))
+
+      # every pixel takes the label of the region it ended up in
+      assert [regions[r].label for r in regionMap] == list(labels)
+
+      # merging only joins whole components
+      for p in range(0, width * height):
+        assert regionMap[p] == regionMap[component.index(component[p])]
+
+      # the merged regions are still connected, and nothing small is left
+      # unless there is nothing to merge it into
+      merged, mergedCount = floodFill(list(regionMap), width, height,
+        connectivity)
+      assert mergedCount == len(regions)
+      assert len(regions) == 1 or min([r.area for r in regions]) >= minArea
+
+      areas, boxes, means = regionStats(list(regionMap), len(regions),
+        width, pixels)
+      assert [r.area for r in regions] == areas
+      assert [r.bbox for r in regions] == boxes
+      assert [r.meanColor() for r in regions] == means
+
+      # large enough components are kept as they were
+      areas = regionStats(component, count, width, pixels)[0]
+      kept = [regionMap[component.index(i)] for i in range(0, count)
+        if areas[i] >= minArea]
+      assert len(set(kept)) == len(kept)
+      for i in range(0, count):
+        if areas[i] >= minArea:
+          assert regions[regionMap[component.index(i)]].label == \
+            original[component.index(i)]
+
+    # the same regions whatever the labels are stored in
+    for result in results[1:]:
+      assert result == results[0]
+
+def testSegmentRefinesBoundaries():
+  # the edge isn't on the coarse grid: 12 is inside the second 8x8 block
+  image = Image.new("L", (32, 16), 255)
+  image.paste(0, (0, 0, 12, 16))
+
+  labels, numRegions, blocks, reference = dfs.segment(image, (8, 4, 2))
+
+  # the mixed coarse block's region is absorbed while refining
+  assert numRegions == 2
+  assert (blocks.size, blocks.cols, blocks.rows) == (2, 16, 8)
+  intensities = [reference[label] for label in labels]
+  assert intensities == [0 if col * 2 < 12 else 255
+    for row in range(0, 8) for col in range(0, 16)]
+
+  # the same as segmenting at the finest size alone
+  single = dfs.segment(image, (2,))
+  assert [single[3][label] for label in single[0]] == intensities
+
+def testSegmentRejectsBlockSizes():
+  with pytest.raises(ValueError):
+    dfs.segment(Image.new("L", (16, 16)), (8, 3))
@@ -0,0 +1,76 @@
+"""
+  RestartRace on synthetic inertia sequences
+"""
+
+from quantize import RestartRace
+
+# feeds a restart's inertia pass by pass; the pass it was stopped at, or
+# None if it ran to the end
+def drive(race, inertias):
+  behind = race.tracker([])
+  for numPass, inertia in enumerate(inertias, 1):
+    if behind(numPass, inertia):
+      return numPass
+  return None
+
+# runs a restart to the end and records it as finished
+def finish(race, inertias):
+  history = []
+  behind = race.tracker(history)
+  for numPass, inertia in enumerate(inertias, 1):
+    assert not behind(numPass, inertia)
+  race.finished(history, inertias[-1])
+
+def testNothingStopsBeforeAFinish():
+  race = RestartRace()
+  assert drive(race, [1000, 900, 800, 700]) is None
+  assert race.stopped == 0
+
+def testStopsWithinTheFirstPasses():
+  race = RestartRace()
+  finish(race, [400, 110, 100, 99])
+
+  # at pass 3 even a drop to 99/100 leaves 158, and it's slowing down
+  assert drive(race, [500, 200, 160, 150]) == 3
+  assert race.stopped == 1
+
+def testKeepsRestartsThatAreCatchingUp():
+  race = RestartRace()
+  finish(race, [500, 110, 100, 99])
+
+  # far behind, but each pass closes more of the gap than is left
+  assert drive(race, [900, 300, 200, 100]) is None
+  assert race.stopped == 0
+
+def testKeepsRestartsThatCanStillWin():
+  race = RestartRace()
+  finish(race, [400, 200, 100])
+
+  # the finished restart halved from pass 2 on: 190 could end at 95
+  assert drive(race, [600, 190, 100, 96]) is None
+  # within the margin of the best is not enough to stop
+  assert drive(race, [600, 208, 104]) is None
+  assert race.stopped == 0
+
+def testFirstPassIsNeverStopped():
+  race = RestartRace(minPasses=2)
+  finish(race, [100, 90, 90])
+  assert drive(race, [10 ** 9]) is None
+
+def testNotStoppedPastTheFinishedPasses():
+  race = RestartRace()
+  finish(race, [300, 100])
+
+  # nothing is known about pass 3 and later
+  assert drive(race, [400, 104, 150, 140]) is None
+
+def testLargestDropOfAnyFinishedRestart():
+  race = RestartRace()
+  finish(race, [500, 300, 120])
+  finish(race, [500, 100, 90])
+
+  # 230 at pass 2 could still drop by the first restart's 120/300
+  assert drive(race, [500, 230, 94]) is None
+  # 300 could only get to 120, more than 5% above 90
+  assert drive(race, [500, 300]) == 2
+  assert race.best == 90
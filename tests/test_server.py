@@ -0,0 +1,116 @@
+"""
+  Local quantization server over a real socket
+
+  Replies sent without reading the request body must end the keep-alive
+  connection, or the body is parsed as the next request. Also checks
+  which queued jobs the worker pool batches.
+"""
+
+import io
+import re
+import json
+import time
+import socket
+import threading
+
+import pytest
+
+from PIL import Image
+
+import server
+
+@pytest.fixture
+def address():
+  pool = server.WorkerPool(1)
+  httpd = server.createServer(pool, port=0, maxBytes=1024)
+  thread = threading.Thread(target=httpd.serve_forever)
+  thread.daemon = True
+  thread.start()
+
+  yield httpd.server_address
+
+  httpd.shutdown()
+  httpd.server_close()
+  pool.close()
+
+# sends raw bytes and reads until the server hangs up
+def exchange(address, data):
+  with socket.create_connection(address, timeout=10) as s:
+    s.sendall(data)
+    replies = b""
+    while True:
+      chunk = s.recv(65536)
+      if not chunk:
+        return replies
+      replies += chunk
+
+SMUGGLED = b"GET /health HTTP/1.1\r\nHost: x\r\n\r\n"
+
+# status codes of the responses (a body can run straight into the next one)
+def statuses(replies):
+  return re.findall(b"HTTP/1.1 (\\d{3}) ", replies)
+
+def testWrongPathDoesNotParseBody(address):
+  replies = exchange(address, b"POST /nope HTTP/1.1\r\nHost: x\r\n"
+    b"Content-Length: %d\r\n\r\n" % len(SMUGGLED) + SMUGGLED)
+  assert statuses(replies) == [b"404"]
+
+def testOversizedBodyDoesNotParseBody(address):
+  body = SMUGGLED + b"x" * 2048
+  replies = exchange(address, b"POST /quantize HTTP/1.1\r\nHost: x\r\n"
+    b"Content-Length: %d\r\n\r\n" % len(body) + body)
+  assert statuses(replies) == [b"413"]
+
+def testChunkedBodyDoesNotParseBody(address):
+  chunk = b"%x\r\n%s\r\n0\r\n\r\n" % (len(SMUGGLED), SMUGGLED)
+  replies = exchange(address, b"POST /quantize HTTP/1.1\r\nHost: x\r\n"
+    b"Transfer-Encoding: chunked\r\n\r\n" + chunk)
+  assert statuses(replies) == [b"411"]
+
+def testKeepAliveAfterQuantize(address):
+  image = io.BytesIO()
+  Image.new("RGB", (8, 8), (200, 10, 10)).save(image, "PNG")
+  body = image.getvalue()
+
+  replies = exchange(address, b"POST /quantize?K=2 HTTP/1.1\r\nHost: x\r\n"
+    b"Content-Length: %d\r\n\r\n" % len(body) + body +
+    b"GET /health HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+  assert statuses(replies) == [b"200", b"200"]
+
+  headers = replies.split(b"\r\n\r\n")[0].decode("latin-1").split("\r\n")
+  stats = [h.split(": ", 1)[1] for h in headers
+    if h.startswith("X-Quantize-Stats")]
+  assert json.loads(stats[0])["width"] == 8
+
+def encodeImage(size, color):
+  image = io.BytesIO()
+  Image.new("RGB", size, color).save(image, "PNG")
+  return image.getvalue()
+
+def testSmallJobsShareAConversionPass():
+  pool = server.WorkerPool(1, batchPixels=32 * 32)
+
+  small = [server.Job(encodeImage((16, 8 + i), (10 * i, 200, 30)), K=2,
+    space="oklab") for i in range(0, 4)]
+  large = server.Job(encodeImage((64, 64), (0, 0, 0)), K=2, space="oklab")
+  rgb = server.Job(encodeImage((16, 16), (1, 2, 3)), K=2)
+  lab = server.Job(encodeImage((16, 16), (1, 2, 3)), K=2, space="lab")
+
+  # the worker waits on the pool's lock after taking the first job, so
+  # the rest are queued by the time it looks for a batch
+  with pool.lock:
+    for job in small[0:1] + [large, rgb] + small[1:] + [lab]:
+      pool.submit(job)
+    time.sleep(0.2)
+
+  for job in small + [large, rgb, lab]:
+    assert job.done.wait(10)
+    assert job.error is None
+  pool.close()
+
+  # only the small OKLab jobs
+  assert pool.metrics.counters["batched"] == len(small)
+  for job in small + [large, rgb, lab]:
+    output = Image.open(io.BytesIO(job.output))
+    assert output.size == (job.stats["width"], job.stats["height"])
+    assert output.size == job.size